@@ -2,6 +2,25 @@
 
 """Top-level package for filter_classified_reads."""
 
+import sys
+
 __author__ = """Peter Kruczkiewicz"""
 __email__ = 'peter.kruczkiewicz@gmail.com'
 __version__ = '0.2.1'
+
+__all__ = ['ReadFilter']
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        """Import `ReadFilter` on first access (PEP 562).
+
+        Importing the package (e.g. for `__version__` in docs/conf.py) then
+        does not pull in pandas and the filtering submodules.
+        """
+        if name == 'ReadFilter':
+            from filter_classified_reads.read_filter import ReadFilter
+            return ReadFilter
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+else:
+    # no module __getattr__ before Python 3.7
+    from filter_classified_reads.read_filter import ReadFilter  # noqa: F401
@@ -0,0 +1,164 @@
+import struct
+import zlib
+from typing import BinaryIO
+
+#: Max uncompressed bytes per BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+#: Gzip magic, deflate method and FEXTRA flag starting each BGZF block
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+#: Empty BGZF block marking the end of a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b00'
+                         '03000000000000000000')
+
+
+def bgzf_block(data: bytes, level: int = 6) -> bytes:
+    """Compress data into a single BGZF block"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    # header (12) + extra subfield (6) + cdata + crc32 (4) + isize (4)
+    bsize = 18 + len(cdata) + 8
+    return (BGZF_MAGIC + b'\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            + struct.pack('<H', bsize - 1)
+            + cdata
+            + struct.pack('<II', zlib.crc32(data), len(data)))
+
+
+class BgzfWriter:
+    """Write a block gzipped (BGZF) file as used for BAM and by pbgzip"""
+
+    def __init__(self, fh: BinaryIO, level: int = 6):
+        self.fh = fh
+        self.level = level
+        self.buffer = bytearray()
+
+    @classmethod
+    def open(cls, path: str, level: int = 6) -> 'BgzfWriter':
+        return cls(open(path, 'wb'), level=level)
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.fh.write(bgzf_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]),
+                                     self.level))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.fh.write(bgzf_block(bytes(self.buffer), self.level))
+            self.buffer = bytearray()
+        self.fh.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+    def __enter__(self) -> 'BgzfWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def is_bgzf(path: str) -> bool:
+    """Check if a file starts with a BGZF block header"""
+    with open(path, 'rb') as fh:
+        header = fh.read(16)
+    return len(header) == 16 \
+        and header[:4] == BGZF_MAGIC \
+        and header[12:14] == b'BC'
+
+
+class BgzfReader:
+    """Random access reader of BGZF files by virtual offset
+
+    A virtual offset is the compressed offset of a BGZF block shifted left
+    16 bits plus the uncompressed offset within the block. The current
+    block is cached so reading records in virtual offset order decompresses
+    each block at most once.
+    """
+
+    def __init__(self, fh: BinaryIO):
+        self.fh = fh
+        self.block = b''
+        self.block_coffset = -1
+        self.next_coffset = 0
+        self.pos = 0
+        self._load_block(0)
+
+    @classmethod
+    def open(cls, path: str) -> 'BgzfReader':
+        return cls(open(path, 'rb'))
+
+    def _load_block(self, coffset: int) -> bool:
+        self.fh.seek(coffset)
+        header = self.fh.read(18)
+        if len(header) < 18:
+            self.block = b''
+            self.block_coffset = coffset
+            self.next_coffset = coffset
+            self.pos = 0
+            return False
+        if header[:4] != BGZF_MAGIC or header[12:14] != b'BC':
+            raise ValueError(f'Invalid BGZF block at offset {coffset}')
+        (bsize,) = struct.unpack_from('<H', header, 16)
+        cdata = self.fh.read(bsize + 1 - 18 - 8)
+        self.fh.read(8)
+        self.block = zlib.decompress(cdata, -15)
+        self.block_coffset = coffset
+        self.next_coffset = coffset + bsize + 1
+        self.pos = 0
+        return True
+
+    def _next_block(self) -> bool:
+        while self._load_block(self.next_coffset):
+            if self.block:
+                return True
+        return False
+
+    def tell(self) -> int:
+        """Virtual offset of the current position"""
+        if self.pos >= len(self.block):
+            return self.next_coffset << 16
+        return (self.block_coffset << 16) | self.pos
+
+    def seek(self, voffset: int) -> None:
+        coffset = voffset >> 16
+        if coffset != self.block_coffset:
+            self._load_block(coffset)
+        self.pos = voffset & 0xffff
+
+    def read(self, n: int) -> bytes:
+        out = bytearray()
+        while n > 0:
+            if self.pos >= len(self.block) and not self._next_block():
+                break
+            chunk = self.block[self.pos:self.pos + n]
+            self.pos += len(chunk)
+            n -= len(chunk)
+            out += chunk
+        return bytes(out)
+
+    def readline(self) -> bytes:
+        out = bytearray()
+        while True:
+            if self.pos >= len(self.block) and not self._next_block():
+                break
+            end = self.block.find(b'\n', self.pos)
+            if end >= 0:
+                out += self.block[self.pos:end + 1]
+                self.pos = end + 1
+                break
+            out += self.block[self.pos:]
+            self.pos = len(self.block)
+        return bytes(out)
+
+    def close(self) -> None:
+        self.fh.close()
+
+    def __enter__(self) -> 'BgzfReader':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
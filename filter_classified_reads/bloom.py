@@ -0,0 +1,186 @@
+import hashlib
+import heapq
+import logging
+import math
+import os
+from itertools import islice
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import attr
+import numpy as np
+
+#: Max number of read IDs held in memory at once while building a prefilter
+CHUNK_SIZE = 1000000
+
+
+def bloom_filter_size(n: int, fpr: float) -> int:
+    """Optimal number of bits for a Bloom filter of `n` items at `fpr`"""
+    return max(8, int(math.ceil(-n * math.log(fpr) / math.log(2) ** 2)))
+
+
+def bloom_filter_n_hashes(n_bits: int, n: int) -> int:
+    """Optimal number of hash functions for a Bloom filter"""
+    return max(1, int(round(n_bits / max(n, 1) * math.log(2))))
+
+
+@attr.s
+class BloomFilter:
+    """Bloom filter over bytes using double hashing of a BLAKE2b digest"""
+    n_bits: int = attr.ib()
+    n_hashes: int = attr.ib()
+    bits: np.ndarray = attr.ib()
+
+    @classmethod
+    def create(cls, n: int, fpr: float = 0.001) -> 'BloomFilter':
+        n_bits = bloom_filter_size(n, fpr)
+        return cls(n_bits=n_bits,
+                   n_hashes=bloom_filter_n_hashes(n_bits, n),
+                   bits=np.zeros((n_bits + 7) // 8, dtype=np.uint8))
+
+    def _positions(self, item: bytes) -> Iterator[int]:
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.n_hashes):
+            yield (h1 + i * h2) % self.n_bits
+
+    def add(self, item: bytes) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: bytes) -> bool:
+        bits = self.bits
+        for pos in self._positions(item):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+def _iter_chunk(path: str, width: int) -> Iterator[bytes]:
+    ids = np.memmap(path, dtype=f'S{width}', mode='r')
+    for start in range(0, ids.size, CHUNK_SIZE):
+        yield from ids[start:start + CHUNK_SIZE].tolist()
+
+
+def _write_sorted_chunks(read_ids: Iterable[Union[str, bytes]],
+                         path: str) -> List[Tuple[str, int]]:
+    """Write read IDs to disk as sorted, deduplicated fixed-width chunks"""
+    chunks = []
+    it = iter(read_ids)
+    while True:
+        chunk = [x.encode() if isinstance(x, str) else x
+                 for x in islice(it, CHUNK_SIZE)]
+        if not chunk:
+            return chunks
+        ids = np.unique(np.array(chunk, dtype=np.bytes_))
+        del chunk
+        chunk_path = f'{path}.chunk{len(chunks)}'
+        ids.tofile(chunk_path)
+        chunks.append((chunk_path, ids.itemsize))
+        del ids
+
+
+class ReadIdPrefilter:
+    """Memory-bounded read ID set
+
+    Read IDs are kept in a sorted fixed-width array memory-mapped from disk.
+    Membership is first tested against a Bloom filter and only positive hits
+    are confirmed with a binary search of the on-disk array, so the number of
+    resident read IDs does not grow with the number of reads.
+    """
+
+    def __init__(self, path: str, width: int, bloom: BloomFilter):
+        self.path = path
+        self.bloom = bloom
+        self.ids = np.memmap(path, dtype=f'S{max(width, 1)}', mode='r') \
+            if os.path.getsize(path) else np.array([], dtype=np.bytes_)
+
+    @classmethod
+    def from_read_ids(cls,
+                      read_ids: Iterable[Union[str, bytes]],
+                      path: str,
+                      fpr: float = 0.001) -> 'ReadIdPrefilter':
+        """Build a prefilter and sorted on-disk read ID array at `path`
+
+        Read IDs are sorted externally: chunks of at most `CHUNK_SIZE` IDs
+        are sorted and written to disk, then merged into `path`, and the
+        Bloom filter is filled from the merged array, so at most one chunk
+        of read IDs is held in memory at a time.
+
+        Args:
+            read_ids: read IDs (duplicates are removed)
+            path: output path of the sorted fixed-width read ID array
+            fpr: Bloom filter false positive rate
+        """
+        chunks = _write_sorted_chunks(read_ids, path)
+        width = max((w for _, w in chunks), default=1)
+        n = 0
+        last = None
+        buffer: List[bytes] = []
+        with open(path, 'wb') as fout:
+            for read_id in heapq.merge(*(_iter_chunk(chunk_path, w)
+                                         for chunk_path, w in chunks)):
+                if read_id == last:
+                    continue
+                last = read_id
+                buffer.append(read_id)
+                n += 1
+                if len(buffer) == CHUNK_SIZE:
+                    np.array(buffer, dtype=f'S{width}').tofile(fout)
+                    buffer = []
+            if buffer:
+                np.array(buffer, dtype=f'S{width}').tofile(fout)
+        for chunk_path, _ in chunks:
+            os.remove(chunk_path)
+        bloom = BloomFilter.create(n, fpr)
+        prefilter = cls(path, width, bloom)
+        for start in range(0, n, CHUNK_SIZE):
+            for read_id in prefilter.ids[start:start + CHUNK_SIZE].tolist():
+                bloom.add(read_id)
+        logging.info(f'Built Bloom filter of {bloom.n_bits} bits with '
+                     f'{bloom.n_hashes} hashes for n={n} read IDs; '
+                     f'sorted read IDs written to "{path}" '
+                     f'({os.path.getsize(path)} bytes)')
+        return prefilter
+
+    def __len__(self) -> int:
+        return self.ids.size
+
+    def __iter__(self) -> Iterator[str]:
+        for read_id in self.ids:
+            yield read_id.decode()
+
+    def isin(self, read_ids: Iterable[Union[str, bytes]]) -> np.ndarray:
+        """Test membership of many read IDs
+
+        Read IDs are looked up `CHUNK_SIZE` at a time with a binary search
+        of the on-disk array, which is never loaded into memory as a whole.
+
+        Returns:
+            boolean array of whether each read ID is in this set
+        """
+        found = []
+        read_ids = iter(read_ids)
+        while True:
+            chunk = [x.encode() if isinstance(x, str) else x
+                     for x in islice(read_ids, CHUNK_SIZE)]
+            if not chunk:
+                break
+            names = np.array(chunk, dtype=np.bytes_)
+            hits = np.zeros(names.size, dtype=bool)
+            fits = np.char.str_len(names) <= self.ids.itemsize
+            if self.ids.size and fits.any():
+                names = names[fits].astype(self.ids.dtype)
+                idx = np.searchsorted(self.ids, names)
+                idx[idx == self.ids.size] = 0
+                hits[fits] = self.ids[idx] == names
+            found.append(hits)
+        return np.concatenate(found) if found else np.zeros(0, dtype=bool)
+
+    def __contains__(self, read_id: Union[str, bytes]) -> bool:
+        if isinstance(read_id, str):
+            read_id = read_id.encode()
+        if len(read_id) > self.ids.itemsize or read_id not in self.bloom:
+            return False
+        idx = np.searchsorted(self.ids, read_id)
+        return bool(idx < self.ids.size and self.ids[idx] == read_id)
@@ -3,26 +3,53 @@
 
 """Console script for filter_classified_reads."""
 import logging
+import os
 import sys
-from typing import Optional, List
+import tempfile
+from contextlib import ExitStack
+from typing import Callable, Optional, List
 
 import click
 
-from filter_classified_reads.util import \
-    parse_taxids_string, \
-    compare_kraken2_and_centrifuge
+from filter_classified_reads.util import parse_taxids_string
+from filter_classified_reads.bloom import ReadIdPrefilter
+from filter_classified_reads.fastq_index import \
+    FastqIndex, \
+    write_reads_indexed
+from filter_classified_reads.formats import \
+    detect_format, \
+    detect_interleaved, \
+    write_filtered_records, \
+    write_records_merge_join
 from filter_classified_reads.io import write_reads_seqtk
-from filter_classified_reads.target_classified_reads import \
-    TargetClassifiedReads, \
-    common_unclassified_reads, \
-    find_target_read_ids
-from filter_classified_reads.const import CENTRIFUGE, KRAKEN2, LOG_FORMAT
+from filter_classified_reads.kreport import write_filtered_kreport
+from filter_classified_reads.planner import \
+    BLOOM, \
+    HASH, \
+    INDEX, \
+    MERGE, \
+    SEQTK, \
+    gather_stats, \
+    plan_filtering, \
+    strategies
+from filter_classified_reads.provenance import \
+    WrittenReads, \
+    write_provenance
+from filter_classified_reads.read_filter import ReadFilter
+from filter_classified_reads.const import \
+    BAM, \
+    FASTQ, \
+    LOG_FORMAT, \
+    SAM, \
+    read_formats
 
 
 @click.command()
 @click.option('-i', '--reads1', type=click.Path(exists=True),
               required=True,
-              help='Single end reads or Forward reads if paired-end specified')
+              help='Single end reads or Forward reads if paired-end specified '
+                   '(FASTQ, FASTA, interleaved FASTQ/FASTA, SAM or unaligned '
+                   'BAM)')
 @click.option('-I', '--reads2', type=click.Path(exists=True),
               help='Reverse reads [optional]')
 @click.option('-c', '--centrifuge-results', type=click.Path(exists=True),
@@ -34,16 +61,81 @@ from filter_classified_reads.const import CENTRIFUGE, KRAKEN2, LOG_FORMAT
 @click.option('-K', '--kraken2-kreport', type=click.Path(exists=True),
               help='Kraken2 report')
 @click.option('-o', '--output1', required=True,
-              help='Filtered forward reads or single-end reads.')
+              help='Filtered forward reads or single-end reads. FASTQ/FASTA '
+                   'and BAM output is always BGZF compressed, SAM output if '
+                   'the path ends with ".gz".')
 @click.option('-O', '--output2',
               help='Filtered reverse reads. Must be specified if providing '
-                   'paired end read input!')
+                   'paired end read input! If specified with interleaved or '
+                   'paired SAM/BAM input, second mates are written here.')
+@click.option('--input-format', default='auto', show_default=True,
+              type=click.Choice(['auto'] + read_formats),
+              help='Input reads format. Output reads are written in the same '
+                   'format.')
+@click.option('--interleaved', is_flag=True,
+              help='FASTQ/FASTA input is interleaved paired reads (detected '
+                   'from the first 2 read names if not specified).')
 @click.option('--exclude-unclassified', is_flag=True,
               help='Do not include unclassified reads in the final output.')
 @click.option('--taxids', default=None,
               help=('Optional NCBI Taxonomy ID(s). Comma-delimited with no '
                     'whitespace if more than one to filter for, '
                     'e.g. "1,2,3,4"'))
+@click.option('--centrifuge-filtered-kreport', default=None,
+              help='Write a Kraken-style report of the Centrifuge '
+                   'classifications of the filtered reads.')
+@click.option('--kraken2-filtered-kreport', default=None,
+              help='Write a Kraken-style report of the Kraken2 '
+                   'classifications of the filtered reads.')
+@click.option('--max-reads-per-taxon', type=click.IntRange(min=1),
+              default=None,
+              help='Randomly sample at most this many reads (or read pairs) '
+                   'per taxon. Unclassified reads are capped as one group.')
+@click.option('--cap-rank', default=None,
+              help='Cap reads per taxon at this rank (e.g. "species" or '
+                   '"S") instead of per classified taxon. Requires '
+                   '`--max-reads-per-taxon`.')
+@click.option('--max-reads', type=click.IntRange(min=1), default=None,
+              help='Randomly sample at most this many reads (or read pairs) '
+                   'in total.')
+@click.option('--seed', type=int, default=42, show_default=True,
+              help='Random seed for sampling reads.')
+@click.option('--low-memory', is_flag=True,
+              help='Keep filtered read IDs in a sorted on-disk array behind '
+                   'a Bloom filter and stream reads in Python instead of '
+                   'passing all read IDs to seqtk. Bounds the memory of the '
+                   'filtered read IDs; classification results are still '
+                   'loaded into memory.')
+@click.option('--bloom-fpr', type=click.FloatRange(min=1e-9, max=0.5),
+              default=0.001, show_default=True,
+              help='Bloom filter false positive rate with `--low-memory`. '
+                   'False positives are confirmed against the on-disk read '
+                   'IDs so only affect speed, not output.')
+@click.option('--use-index', is_flag=True,
+              help='Extract reads from uncompressed or BGZF FASTQ by seeking '
+                   'to record offsets in a read name index, which is built '
+                   'and saved next to each FASTQ if needed. Fastest when '
+                   'target reads are a small fraction of all reads.')
+@click.option('--index-dir', default=None,
+              type=click.Path(file_okay=False, writable=True),
+              help='Directory to save and load FASTQ read name indexes '
+                   'instead of next to each FASTQ (e.g. if the FASTQ '
+                   'directory is read-only).')
+@click.option('--strategy', default='auto', show_default=True,
+              type=click.Choice(['auto'] + strategies),
+              help='Read filtering strategy. "auto" picks the cheapest '
+                   'strategy estimated from the inputs, available memory '
+                   'and CPUs. `--low-memory` implies "bloom" and '
+                   '`--use-index` implies "index".')
+@click.option('--explain', is_flag=True,
+              help='Print the filtering plan with estimated costs of each '
+                   'strategy and exit without writing reads.')
+@click.option('--provenance', default=None,
+              help='Write a per-read table of Kraken2 and Centrifuge taxids, '
+                   'matched target taxid, the rule that kept or dropped the '
+                   'read and mate status as compressed columnar arrays '
+                   '(.npz). Read it with '
+                   '`filter_classified_reads.provenance.read_provenance`.')
 def main(reads1: str,
          reads2: Optional[str],
          centrifuge_results: Optional[str],
@@ -52,8 +144,23 @@ def main(reads1: str,
          kraken2_kreport: Optional[str],
          output1: str,
          output2: Optional[str],
+         input_format: str,
+         interleaved: bool,
          exclude_unclassified: bool,
-         taxids: Optional[str]):
+         taxids: Optional[str],
+         centrifuge_filtered_kreport: Optional[str],
+         kraken2_filtered_kreport: Optional[str],
+         max_reads_per_taxon: Optional[int],
+         cap_rank: Optional[str],
+         max_reads: Optional[int],
+         seed: int,
+         low_memory: bool,
+         bloom_fpr: float,
+         use_index: bool,
+         index_dir: Optional[str],
+         strategy: str,
+         explain: bool,
+         provenance: Optional[str]):
     """Filter viral reads and unclassified based on classification results.
 
     Requires either Kraken2 or Centrifuge classification results or both of a
@@ -78,6 +185,17 @@ def main(reads1: str,
             'Both the Kraken2 results and report files must be specified '
             'with `-k` for the results file and `-K` for the Kraken report '
             'file!')
+    if centrifuge_filtered_kreport and not centrifuge_results:
+        raise click.exceptions.UsageError(
+            'Centrifuge results and report must be specified to write a '
+            'filtered Centrifuge Kraken-style report!')
+    if kraken2_filtered_kreport and not kraken2_results:
+        raise click.exceptions.UsageError(
+            'Kraken2 results and report must be specified to write a '
+            'filtered Kraken2 report!')
+    if cap_rank and max_reads_per_taxon is None:
+        raise click.exceptions.UsageError(
+            '`--max-reads-per-taxon` must be specified with `--cap-rank`!')
     logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
     parsed_taxids = try_parse_taxids(taxids)
     if reads2 and output2 is None:
@@ -85,51 +203,159 @@ def main(reads1: str,
                                f'specify an output file for the filtered '
                                f'reverse reads with `-O/--output2`!')
 
-    tcr = TargetClassifiedReads()
-    if centrifuge_results and centrifuge_kreport:
-        tcr = find_target_read_ids(tcr=tcr,
-                                   kreport=centrifuge_kreport,
-                                   results=centrifuge_results,
-                                   method=CENTRIFUGE,
-                                   taxids=parsed_taxids)
-    if kraken2_results and kraken2_kreport:
-        tcr = find_target_read_ids(tcr=tcr,
-                                   kreport=kraken2_kreport,
-                                   results=kraken2_results,
-                                   method=KRAKEN2,
-                                   taxids=parsed_taxids)
-
-    target_read_ids = tcr.centrifuge_targets | tcr.kraken2_targets
-
-    unclassified_read_ids = common_unclassified_reads(tcr)
-    logging.info(f'Found N={len(unclassified_read_ids)} common unclassified '
-                 f'reads by all classification methods.')
-
-    compare_kraken2_and_centrifuge(centrifuge_results,
-                                   kraken2_results,
-                                   target_read_ids,
-                                   tcr)
-
-    if exclude_unclassified:
-        filtered_read_ids = list(target_read_ids)
-    else:
-        filtered_read_ids = list(target_read_ids | unclassified_read_ids)
-    # sorting in case that speeds up reading from FASTQ file
-    filtered_read_ids.sort()
-    if len(filtered_read_ids) == 0:
-        logging.warning('No reads found for taxa of interest' +
-                        " including unclassified" if not exclude_unclassified
-                        else "" + '!')
-    else:
-        logging.info(f'Writing n={len(filtered_read_ids)} filtered reads '
-                     f'from "{reads1}" to "{output1}"')
-
-        write_reads_seqtk(reads1, filtered_read_ids, output1)
-        if reads2:
-            logging.info(f'Writing n={len(filtered_read_ids)} filtered reads '
-                         f'from "{reads2}" to "{output2}"')
-            write_reads_seqtk(reads2, filtered_read_ids, output2)
-    logging.info('Done!')
+    with ExitStack() as stack:
+        # build the prefilter without first materializing all read IDs
+        use_prefilter = low_memory or strategy == BLOOM
+        read_filter = ReadFilter.from_classifications(
+            kraken2_results=kraken2_results,
+            kraken2_kreport=kraken2_kreport,
+            centrifuge_results=centrifuge_results,
+            centrifuge_kreport=centrifuge_kreport,
+            taxids=parsed_taxids,
+            exclude_unclassified=exclude_unclassified,
+            max_reads_per_taxon=max_reads_per_taxon,
+            cap_rank=cap_rank,
+            max_reads=max_reads,
+            seed=seed,
+            prefilter_path=(temp_prefilter_path(stack)
+                            if use_prefilter else None),
+            bloom_fpr=bloom_fpr)
+        tcr = read_filter.tcr
+        fmt = detect_format(reads1) if input_format == 'auto' else input_format
+        interleaved = interleaved or detect_interleaved(reads1, fmt)
+        stats = gather_stats(read_filter, reads1, reads2, fmt, interleaved,
+                             index_dir=index_dir)
+        if strategy == 'auto':
+            strategy = BLOOM if low_memory else INDEX if use_index else None
+        plan = plan_filtering(stats, strategy, track_written=bool(provenance))
+        logging.info(f'Reads format is {fmt}'
+                     f'{" (interleaved)" if interleaved else ""}. Filtering '
+                     f'reads with the "{plan.strategy}" strategy (estimated '
+                     f'cost ~{plan.costs[plan.strategy]:.2f}s)')
+        if explain:
+            click.echo(plan.explain())
+            return
+        if plan.strategy == BLOOM \
+                and not isinstance(read_filter.read_ids, ReadIdPrefilter):
+            read_filter = read_filter.with_prefilter(
+                temp_prefilter_path(stack),
+                bloom_fpr=bloom_fpr)
+        # only track written reads for provenance
+        written = WrittenReads.for_filter(read_filter) if provenance \
+            else None
+        if len(read_filter) == 0:
+            logging.warning('No reads found for taxa of interest' +
+                            " including unclassified"
+                            if not exclude_unclassified else "" + '!')
+        elif reads2 or not (output2 and (interleaved or fmt in (SAM, BAM))):
+            logging.info(f'Writing n={len(read_filter)} filtered reads '
+                         f'from "{reads1}" to "{output1}"')
+            used_strategy = write_reads(reads1, read_filter, output1,
+                                        fmt=fmt, interleaved=interleaved,
+                                        strategy=plan.strategy,
+                                        on_write=written and written.observer(
+                                            1 if reads2 else 0),
+                                        index_dir=index_dir)
+            if reads2:
+                logging.info(f'Writing n={len(read_filter)} filtered '
+                             f'reads from "{reads2}" to "{output2}"')
+                write_reads(reads2, read_filter, output2,
+                            fmt=fmt, interleaved=interleaved,
+                            strategy=used_strategy,
+                            on_write=written and written.observer(2),
+                            index_dir=index_dir)
+        else:
+            logging.info(f'Writing n={len(read_filter)} filtered read '
+                         f'pairs from "{reads1}" to "{output1}" and '
+                         f'"{output2}"')
+            write_reads(reads1, read_filter, output1, output2,
+                        fmt=fmt, interleaved=interleaved,
+                        strategy=plan.strategy,
+                        on_write=written and written.observer(),
+                        index_dir=index_dir)
+        if centrifuge_filtered_kreport:
+            logging.info(f'Writing Centrifuge Kraken-style report of filtered '
+                         f'reads to "{centrifuge_filtered_kreport}"')
+            write_filtered_kreport(tcr.centrifuge_df_results,
+                                   tcr.centrifuge_df_kreport,
+                                   read_filter.read_ids,
+                                   centrifuge_filtered_kreport)
+        if kraken2_filtered_kreport:
+            logging.info(f'Writing Kraken2 report of filtered reads to '
+                         f'"{kraken2_filtered_kreport}"')
+            write_filtered_kreport(tcr.kraken2_df_results,
+                                   tcr.kraken2_df_kreport,
+                                   read_filter.read_ids,
+                                   kraken2_filtered_kreport)
+        if written is not None:
+            write_provenance(read_filter, written, provenance)
+        logging.info('Done!')
+
+
+def temp_prefilter_path(stack: ExitStack) -> str:
+    """Path for on-disk read IDs in a temporary directory removed on exit"""
+    tmp_dir = stack.enter_context(
+        tempfile.TemporaryDirectory(prefix='filter_classified_reads-'))
+    return os.path.join(tmp_dir, 'read_ids.bin')
+
+
+def write_reads(reads_path: str,
+                read_filter: ReadFilter,
+                output1: str,
+                output2: Optional[str] = None,
+                fmt: str = FASTQ,
+                interleaved: bool = False,
+                strategy: str = SEQTK,
+                on_write: Optional[Callable[[bytes, int], None]] = None,
+                index_dir: Optional[str] = None) -> str:
+    """Write filtered reads using a read filtering strategy
+
+    Output is the same whichever strategy is used: the filtered records in
+    reads file order, with FASTQ/FASTA BGZF compressed as by
+    `seqtk subseq | pbgzip -c`. `on_write` is called with the name and mate
+    number of each written read except with the "seqtk" strategy.
+
+    Returns:
+        Strategy used, which is "hash" if reads were not in classification
+        results order for the "merge" strategy
+    """
+    read_ids = read_filter.read_ids
+    if strategy == SEQTK:
+        write_reads_seqtk(reads_path, read_ids, output1)
+        return strategy
+    if strategy == INDEX:
+        write_reads_indexed(reads_path,
+                            FastqIndex.for_reads(reads_path, index_dir),
+                            read_ids.ids
+                            if isinstance(read_ids, ReadIdPrefilter)
+                            else read_ids,
+                            output1,
+                            on_write=on_write)
+        return strategy
+    if strategy == MERGE:
+        ordered_names, keep = read_filter.results_order()
+        try:
+            write_records_merge_join(reads_path,
+                                     ordered_names,
+                                     keep,
+                                     output1,
+                                     output2,
+                                     fmt=fmt,
+                                     interleaved=interleaved,
+                                     on_write=on_write)
+            return strategy
+        except ValueError as ex:
+            logging.warning(f'{ex}. Filtering reads with the "{HASH}" '
+                            f'strategy instead.')
+            strategy = HASH
+    write_filtered_records(reads_path,
+                           read_filter.names,
+                           output1,
+                           output2,
+                           fmt=fmt,
+                           interleaved=interleaved,
+                           on_write=on_write)
+    return strategy
 
 
 def try_parse_taxids(taxids: Optional[str]) -> Optional[List[int]]:
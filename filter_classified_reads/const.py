@@ -7,3 +7,19 @@ LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s ' \
 CENTRIFUGE = 'centrifuge'
 KRAKEN2 = 'kraken2'
 classification_methods = {CENTRIFUGE, KRAKEN2}
+RANK_CODES = {
+    'domain': 'D',
+    'superkingdom': 'D',
+    'kingdom': 'K',
+    'phylum': 'P',
+    'class': 'C',
+    'order': 'O',
+    'family': 'F',
+    'genus': 'G',
+    'species': 'S',
+}
+FASTQ = 'fastq'
+FASTA = 'fasta'
+SAM = 'sam'
+BAM = 'bam'
+read_formats = [FASTQ, FASTA, SAM, BAM]
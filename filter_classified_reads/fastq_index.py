@@ -0,0 +1,242 @@
+import logging
+import os
+from typing import \
+    BinaryIO, Callable, Iterable, Iterator, Optional, Tuple, Union
+
+import attr
+import numpy as np
+
+from filter_classified_reads.bgzf import BgzfReader, is_bgzf
+from filter_classified_reads.formats import fastq_record_name, \
+    open_records_output, strip_mate_suffix
+from filter_classified_reads.const import FASTQ
+from filter_classified_reads.io import GZIP_MAGIC
+
+PLAIN = 'plain'
+BGZF = 'bgzf'
+GZIP = 'gzip'
+#: Max bytes between records to read in one request for plain FASTQ
+MAX_GAP = 1 << 16
+#: Max bytes to read in one request for plain FASTQ
+MAX_BATCH_BYTES = 1 << 22
+
+
+def fastq_compression(path: str) -> str:
+    """Get FASTQ compression type: PLAIN, BGZF or GZIP"""
+    if is_bgzf(path):
+        return BGZF
+    with open(path, 'rb') as fh:
+        if fh.read(2) == GZIP_MAGIC:
+            return GZIP
+    return PLAIN
+
+
+def default_index_path(reads_path: str,
+                       index_dir: Optional[str] = None) -> str:
+    """Index path next to the reads file or in `index_dir` if specified"""
+    if index_dir:
+        return os.path.join(index_dir,
+                            f'{os.path.basename(reads_path)}.fcri.npz')
+    return f'{reads_path}.fcri.npz'
+
+
+def _iter_record_offsets(fh: Union[BinaryIO, BgzfReader]) \
+        -> Iterator[Tuple[bytes, int, int]]:
+    while True:
+        offset = fh.tell()
+        header = fh.readline()
+        if not header:
+            return
+        if not header.strip():
+            continue
+        lines = [fh.readline() for _ in range(3)]
+        name = fastq_record_name(header, *lines)
+        yield name, offset, len(header) + sum(len(x) for x in lines)
+
+
+@attr.s
+class FastqIndex:
+    """Index of FASTQ read names to record offsets
+
+    Offsets are byte offsets for uncompressed FASTQ and BGZF virtual offsets
+    for block gzipped FASTQ. Arrays are sorted by read name and `ordinals`
+    holds the position of each record in the FASTQ file.
+    """
+    compression: str = attr.ib()
+    names: np.ndarray = attr.ib()
+    offsets: np.ndarray = attr.ib()
+    lengths: np.ndarray = attr.ib()
+    ordinals: np.ndarray = attr.ib()
+    reads_size: int = attr.ib(default=0)
+    reads_mtime: float = attr.ib(default=0.0)
+
+    @classmethod
+    def build(cls, reads_path: str) -> 'FastqIndex':
+        """Build an index for an uncompressed or BGZF FASTQ file
+
+        Raises:
+            ValueError: if the FASTQ is Gzipped but not block gzipped
+        """
+        compression = fastq_compression(reads_path)
+        if compression not in (PLAIN, BGZF):
+            raise ValueError(f'Cannot index {compression} compressed FASTQ '
+                             f'"{reads_path}". Only uncompressed or BGZF '
+                             f'(e.g. pbgzip or bgzip) FASTQ can be indexed.')
+        names = []
+        offsets = []
+        lengths = []
+        fh = BgzfReader.open(reads_path) if compression == BGZF \
+            else open(reads_path, 'rb')
+        with fh:
+            for name, offset, length in _iter_record_offsets(fh):
+                names.append(name)
+                offsets.append(offset)
+                lengths.append(length)
+        names = np.array(names, dtype=np.bytes_)
+        order = np.argsort(names, kind='stable')
+        stat = os.stat(reads_path)
+        logging.info(f'Indexed n={names.size} {compression} FASTQ records '
+                     f'in "{reads_path}"')
+        return cls(compression=compression,
+                   names=names[order],
+                   offsets=np.array(offsets, dtype=np.uint64)[order],
+                   lengths=np.array(lengths, dtype=np.uint32)[order],
+                   ordinals=order.astype(np.uint64),
+                   reads_size=stat.st_size,
+                   reads_mtime=stat.st_mtime)
+
+    @classmethod
+    def load(cls, path: str) -> 'FastqIndex':
+        with np.load(path) as npz:
+            return cls(compression=str(npz['compression']),
+                       names=npz['names'],
+                       offsets=npz['offsets'],
+                       lengths=npz['lengths'],
+                       ordinals=npz['ordinals'],
+                       reads_size=int(npz['reads_size']),
+                       reads_mtime=float(npz['reads_mtime']))
+
+    @classmethod
+    def for_reads(cls,
+                  reads_path: str,
+                  index_dir: Optional[str] = None) -> 'FastqIndex':
+        """Load the index of a FASTQ file, building it if missing or stale
+
+        A built index is saved next to the FASTQ file or in `index_dir` if
+        specified. If it cannot be saved (e.g. read-only directory), it is
+        only kept in memory.
+        """
+        index_path = default_index_path(reads_path, index_dir)
+        if os.path.exists(index_path):
+            index = cls.load(index_path)
+            if index.is_current(reads_path):
+                logging.info(f'Loaded FASTQ index "{index_path}"')
+                return index
+            logging.info(f'FASTQ index "{index_path}" is out of date')
+        index = cls.build(reads_path)
+        try:
+            index.save(index_path)
+        except OSError as ex:
+            logging.warning(f'Could not save FASTQ index to "{index_path}" '
+                            f'({ex}). Keeping the index in memory only. Use '
+                            f'`--index-dir` to save indexes to a writable '
+                            f'directory.')
+        return index
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as fh:
+            np.savez(fh,
+                     compression=np.array(self.compression),
+                     names=self.names,
+                     offsets=self.offsets,
+                     lengths=self.lengths,
+                     ordinals=self.ordinals,
+                     reads_size=np.array(self.reads_size),
+                     reads_mtime=np.array(self.reads_mtime))
+
+    def is_current(self, reads_path: str) -> bool:
+        stat = os.stat(reads_path)
+        return stat.st_size == self.reads_size \
+            and stat.st_mtime == self.reads_mtime
+
+    def __len__(self) -> int:
+        return self.names.size
+
+    def lookup(self, names: Iterable[Union[str, bytes]]) -> np.ndarray:
+        """Get indexes of records with the specified names in file order"""
+        if not isinstance(names, np.ndarray):
+            names = np.array([x.encode() if isinstance(x, str) else x
+                              for x in names], dtype=np.bytes_)
+        names = names[np.char.str_len(names) <= self.names.itemsize]
+        left = np.searchsorted(self.names, names, side='left')
+        right = np.searchsorted(self.names, names, side='right')
+        counts = right - left
+        idx = np.repeat(left - np.cumsum(counts) + counts, counts) \
+            + np.arange(counts.sum())
+        return idx[np.argsort(self.ordinals[idx], kind='stable')]
+
+    def iter_records(self,
+                     reads_path: str,
+                     names: Iterable[Union[str, bytes]]) -> Iterator[bytes]:
+        """Iterate over raw records with the specified names in file order
+
+        Records of uncompressed FASTQ are read in coalesced batches of
+        nearby records of at most `MAX_BATCH_BYTES` (or a single record if
+        larger). Records of BGZF FASTQ are read by virtual offset so
+        each BGZF block holding target records is decompressed once.
+        """
+        idx = self.lookup(names)
+        offsets = self.offsets[idx].astype(np.int64)
+        lengths = self.lengths[idx].astype(np.int64)
+        if self.compression == BGZF:
+            with BgzfReader.open(reads_path) as reader:
+                for offset, length in zip(offsets.tolist(), lengths.tolist()):
+                    reader.seek(offset)
+                    yield reader.read(length)
+            return
+        ends = (offsets + lengths).tolist()
+        offsets = offsets.tolist()
+        lengths = lengths.tolist()
+        n = len(offsets)
+        with open(reads_path, 'rb') as fh:
+            first = 0
+            for last in range(n):
+                if last + 1 < n \
+                        and offsets[last + 1] - ends[last] <= MAX_GAP \
+                        and ends[last + 1] - offsets[first] <= MAX_BATCH_BYTES:
+                    continue
+                start = offsets[first]
+                fh.seek(start)
+                data = fh.read(ends[last] - start)
+                for i in range(first, last + 1):
+                    rel = offsets[i] - start
+                    yield data[rel:rel + lengths[i]]
+                first = last + 1
+
+
+def write_reads_indexed(reads_path: str,
+                        index: FastqIndex,
+                        names: Iterable[Union[str, bytes]],
+                        output_path: str,
+                        on_write: Optional[Callable[[bytes, int], None]]
+                        = None) -> int:
+    """Write FASTQ records with specified names by seeking with an index
+
+    Args:
+        reads_path: FASTQ file path
+        index: index of the FASTQ file
+        names: read names
+        output_path: output FASTQ path
+        on_write: optional function called with the name and mate number
+            (always 0) of each written read
+    Returns:
+        Number of reads written
+    """
+    n_written = 0
+    with open_records_output(output_path, FASTQ) as fout:
+        for record in index.iter_records(reads_path, names):
+            fout.write(record)
+            n_written += 1
+            if on_write is not None:
+                on_write(strip_mate_suffix(record[1:].split(None, 1)[0]), 0)
+    return n_written
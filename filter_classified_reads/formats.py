@@ -0,0 +1,358 @@
+import struct
+from typing import \
+    BinaryIO, Callable, Container, Iterator, Optional, Sequence, Tuple
+
+from filter_classified_reads.bgzf import BgzfWriter
+from filter_classified_reads.const import BAM, FASTA, FASTQ, SAM
+from filter_classified_reads.io import open_reads
+
+SAM_HEADER_TAGS = (b'@HD\t', b'@SQ\t', b'@RG\t', b'@PG\t', b'@CO\t')
+BAM_MAGIC = b'BAM\x01'
+BAM_FLAG_READ1 = 0x40
+BAM_FLAG_READ2 = 0x80
+
+#: (read name, raw record bytes, mate number (0 if unpaired or unknown))
+Record = Tuple[bytes, bytes, int]
+
+
+def strip_mate_suffix(name: bytes) -> bytes:
+    """Remove a "/1" or "/2" mate suffix from a read name"""
+    if name[-2:] in (b'/1', b'/2'):
+        return name[:-2]
+    return name
+
+
+def detect_format(path: str) -> str:
+    """Detect the format of a possibly Gzipped or BGZF compressed reads file
+
+    Raises:
+        ValueError: if the format could not be detected
+    """
+    with open_reads(path) as fh:
+        head = fh.read(4096)
+    if head.startswith(BAM_MAGIC):
+        return BAM
+    if head.startswith(SAM_HEADER_TAGS):
+        return SAM
+    if head.startswith(b'>'):
+        return FASTA
+    if head.startswith(b'@'):
+        return FASTQ
+    first_line = head.split(b'\n', 1)[0]
+    if first_line.count(b'\t') >= 10:
+        return SAM
+    raise ValueError(f'Could not detect format of reads file "{path}"')
+
+
+def detect_interleaved(path: str, fmt: str) -> bool:
+    """Check if the first two FASTQ/FASTA records are mates of a pair"""
+    if fmt not in (FASTQ, FASTA):
+        return False
+    records = iter_records(path, fmt)
+    first = next(records, None)
+    second = next(records, None)
+    return first is not None \
+        and second is not None \
+        and first[0] == second[0]
+
+
+def fastq_record_name(header: bytes,
+                      seq: bytes,
+                      sep: bytes,
+                      qual: bytes) -> bytes:
+    """Get the read name of a FASTQ record from its 4 lines
+
+    Raises:
+        ValueError: if the record is malformed or truncated
+    """
+    fields = header[1:].split(None, 1)
+    if not header.startswith(b'@') or not fields \
+            or not sep.startswith(b'+') or not qual.strip():
+        raise ValueError(f'Malformed or truncated FASTQ record with header '
+                         f'{header.rstrip()!r}: expected "@<name>" header, '
+                         f'sequence, "+" separator and quality lines')
+    return strip_mate_suffix(fields[0])
+
+
+def iter_fastq_records(fh: BinaryIO) -> Iterator[Tuple[bytes, bytes]]:
+    """Iterate over the read name and raw bytes of FASTQ records
+
+    Blank lines between records are skipped.
+
+    Raises:
+        ValueError: if a record is malformed or truncated
+    """
+    for header in fh:
+        if not header.strip():
+            continue
+        seq, sep, qual = fh.readline(), fh.readline(), fh.readline()
+        name = fastq_record_name(header, seq, sep, qual)
+        yield name, header + seq + sep + qual
+
+
+def iter_fasta_records(fh: BinaryIO) -> Iterator[Tuple[bytes, bytes]]:
+    name = None
+    record = bytearray()
+    for line in fh:
+        if line.startswith(b'>'):
+            if name is not None:
+                yield name, bytes(record)
+            name = strip_mate_suffix(line[1:].split(None, 1)[0])
+            record = bytearray(line)
+        else:
+            record += line
+    if name is not None:
+        yield name, bytes(record)
+
+
+def read_sam_header(fh: BinaryIO) -> Tuple[bytes, bytes]:
+    """Read SAM header lines and return them with the first alignment line"""
+    header = bytearray()
+    for line in fh:
+        if not line.startswith(b'@'):
+            return bytes(header), line
+        header += line
+    return bytes(header), b''
+
+
+def iter_sam_records(fh: BinaryIO) -> Iterator[Record]:
+    _, line = read_sam_header(fh)
+    while line:
+        if line.strip():
+            qname, flag, _ = line.split(b'\t', 2)
+            yield strip_mate_suffix(qname), line, sam_flag_mate(int(flag))
+        line = fh.readline()
+
+
+def sam_flag_mate(flag: int) -> int:
+    if flag & BAM_FLAG_READ1:
+        return 1
+    if flag & BAM_FLAG_READ2:
+        return 2
+    return 0
+
+
+def read_bam_header(fh: BinaryIO) -> bytes:
+    """Read the raw uncompressed BAM header (magic, text and references)
+
+    Raises:
+        ValueError: if the file is not BAM
+    """
+    magic = fh.read(4)
+    if magic != BAM_MAGIC:
+        raise ValueError(f'Not a BAM file! Expected magic {BAM_MAGIC!r}, '
+                         f'got {magic!r}')
+    header = bytearray(magic)
+    l_text_bytes = fh.read(4)
+    (l_text,) = struct.unpack('<i', l_text_bytes)
+    header += l_text_bytes + fh.read(l_text)
+    n_ref_bytes = fh.read(4)
+    (n_ref,) = struct.unpack('<i', n_ref_bytes)
+    header += n_ref_bytes
+    for _ in range(n_ref):
+        l_name_bytes = fh.read(4)
+        (l_name,) = struct.unpack('<i', l_name_bytes)
+        header += l_name_bytes + fh.read(l_name + 4)
+    return bytes(header)
+
+
+def iter_bam_records(fh: BinaryIO) -> Iterator[Record]:
+    read_bam_header(fh)
+    while True:
+        block_size_bytes = fh.read(4)
+        if len(block_size_bytes) < 4:
+            return
+        (block_size,) = struct.unpack('<i', block_size_bytes)
+        data = fh.read(block_size)
+        l_read_name = data[8]
+        (flag,) = struct.unpack_from('<H', data, 14)
+        name = strip_mate_suffix(data[32:32 + l_read_name - 1])
+        yield name, block_size_bytes + data, sam_flag_mate(flag)
+
+
+def iter_records(path: str,
+                 fmt: Optional[str] = None,
+                 interleaved: bool = False) -> Iterator[Record]:
+    """Iterate over the read name, raw bytes and mate number of each record
+
+    Read names are the FASTQ/FASTA header up to the first whitespace or the
+    SAM/BAM QNAME with any "/1" or "/2" mate suffix removed. Mates of
+    interleaved FASTQ/FASTA records alternate between 1 and 2 and SAM/BAM
+    mates are taken from the FLAG.
+
+    Args:
+        path: reads file path (optionally Gzip or BGZF compressed)
+        fmt: reads file format (detected if not specified)
+        interleaved: FASTQ/FASTA records are interleaved read pairs
+    """
+    if fmt is None:
+        fmt = detect_format(path)
+    with open_reads(path) as fh:
+        if fmt == BAM:
+            yield from iter_bam_records(fh)
+        elif fmt == SAM:
+            yield from iter_sam_records(fh)
+        else:
+            records = iter_fastq_records(fh) if fmt == FASTQ \
+                else iter_fasta_records(fh)
+            for i, (name, record) in enumerate(records):
+                yield name, record, ((i % 2) + 1 if interleaved else 0)
+
+
+def iter_interleaved_pairs(path: str,
+                           fmt: Optional[str] = None) \
+        -> Iterator[Tuple[bytes, bytes, bytes]]:
+    """Iterate over (name, mate 1 record, mate 2 record) of adjacent mates
+
+    Raises:
+        ValueError: if adjacent records are not mates of the same pair
+    """
+    records = iter_records(path, fmt, interleaved=True)
+    for name1, record1, mate1 in records:
+        name2, record2, mate2 = next(records, (None, b'', 0))
+        if name1 != name2 or {mate1, mate2} != {1, 2}:
+            raise ValueError(f'Expected adjacent mates of a read pair in '
+                             f'"{path}" but got "{name1}" (mate {mate1}) '
+                             f'and "{name2}" (mate {mate2})')
+        if mate1 == 2:
+            record1, record2 = record2, record1
+        yield name1, record1, record2
+
+
+def read_header(path: str, fmt: str) -> bytes:
+    """Read the raw SAM/BAM header of a reads file (empty for FASTQ/FASTA)"""
+    with open_reads(path) as fh:
+        if fmt == BAM:
+            return read_bam_header(fh)
+        if fmt == SAM:
+            return read_sam_header(fh)[0]
+    return b''
+
+
+def open_records_output(path: str, fmt: str) -> BinaryIO:
+    """Open an output file for raw records
+
+    FASTQ/FASTA output is always BGZF compressed like the output of
+    `seqtk subseq reads.fq - | pbgzip -c` so that the output is the same
+    whichever filtering strategy is used. BAM output is BGZF compressed and
+    SAM output is BGZF compressed if the path ends with ".gz".
+    """
+    if fmt in (BAM, FASTQ, FASTA) or path.endswith('.gz'):
+        return BgzfWriter.open(path)
+    return open(path, 'wb')
+
+
+def write_filtered_records(reads_path: str,
+                           names: Container[bytes],
+                           output1: str,
+                           output2: Optional[str] = None,
+                           fmt: Optional[str] = None,
+                           interleaved: bool = False,
+                           on_write: Optional[Callable[[bytes, int], None]]
+                           = None) -> int:
+    """Stream reads with names in a container to output in the same format
+
+    Mates of a pair share a read name so are kept or dropped together. If
+    `output2` is specified, second mates of interleaved FASTQ/FASTA or paired
+    SAM/BAM input are written to `output2` and all other reads to `output1`.
+    SAM/BAM headers are copied to each output.
+
+    Args:
+        reads_path: reads file path
+        names: container of read names as bytes
+        output1: output path for filtered reads or first mates
+        output2: optional output path for second mates
+        fmt: reads file format (detected if not specified)
+        interleaved: FASTQ/FASTA records are interleaved read pairs
+        on_write: optional function called with the name and mate number of
+            each written record
+    Returns:
+        Number of records written
+    """
+    if fmt is None:
+        fmt = detect_format(reads_path)
+    header = read_header(reads_path, fmt)
+    n_written = 0
+    fout1 = open_records_output(output1, fmt)
+    fout2 = open_records_output(output2, fmt) if output2 else fout1
+    try:
+        fout1.write(header)
+        if output2:
+            fout2.write(header)
+        for name, record, mate in iter_records(reads_path, fmt, interleaved):
+            if name in names:
+                (fout2 if mate == 2 else fout1).write(record)
+                n_written += 1
+                if on_write is not None:
+                    on_write(name, mate)
+    finally:
+        fout1.close()
+        if output2:
+            fout2.close()
+    return n_written
+
+
+def write_records_merge_join(reads_path: str,
+                             ordered_names: Sequence[str],
+                             keep: Sequence[bool],
+                             output1: str,
+                             output2: Optional[str] = None,
+                             fmt: Optional[str] = None,
+                             interleaved: bool = False,
+                             on_write: Optional[Callable[[bytes, int], None]]
+                             = None) -> int:
+    """Write reads by merge-joining with read names in the same order
+
+    Read names in `ordered_names` must be in the same order as the reads in
+    `reads_path` (e.g. classification results of the reads), so no read
+    name lookup table is needed. Adjacent records with the same name (mates)
+    share one entry in `ordered_names`.
+
+    Args:
+        reads_path: reads file path
+        ordered_names: read names in reads file order
+        keep: whether to keep each read in `ordered_names`
+        output1: output path for filtered reads or first mates
+        output2: optional output path for second mates
+        fmt: reads file format (detected if not specified)
+        interleaved: FASTQ/FASTA records are interleaved read pairs
+        on_write: optional function called with the name and mate number of
+            each written record
+    Returns:
+        Number of records written
+    Raises:
+        ValueError: if the reads are not in the same order as `ordered_names`
+    """
+    if fmt is None:
+        fmt = detect_format(reads_path)
+    header = read_header(reads_path, fmt)
+    n_written = 0
+    k = -1
+    last_name = None
+    keep_read = False
+    fout1 = open_records_output(output1, fmt)
+    fout2 = open_records_output(output2, fmt) if output2 else fout1
+    try:
+        fout1.write(header)
+        if output2:
+            fout2.write(header)
+        for name, record, mate in iter_records(reads_path, fmt, interleaved):
+            if name != last_name:
+                k += 1
+                if k >= len(ordered_names) \
+                        or ordered_names[k] != name.decode():
+                    raise ValueError(f'Read "{name.decode()}" (record {k}) '
+                                     f'in "{reads_path}" is not in the same '
+                                     f'order as the classification results')
+                last_name = name
+                keep_read = keep[k]
+            if keep_read:
+                (fout2 if mate == 2 else fout1).write(record)
+                n_written += 1
+                if on_write is not None:
+                    on_write(name, mate)
+    finally:
+        fout1.close()
+        if output2:
+            fout2.close()
+    return n_written
@@ -1,15 +1,28 @@
+import gzip
 import os
 import subprocess as sp
-from typing import Iterable
+from typing import BinaryIO, Iterable
 
 import pandas as pd
 
+#: Magic bytes starting Gzip (and BGZF) files
+GZIP_MAGIC = b'\x1f\x8b'
+
 
 def read_kraken_report(path):
     fields = 'perc n_reads n_reads_specific rank taxid sciname'.split()
     return pd.read_csv(path, sep='\t', header=None, names=fields)
 
 
+def write_kraken_report(df: pd.DataFrame, path: str) -> None:
+    """Write a Kraken-style report DataFrame in the Kraken2 report format"""
+    with open(path, 'w') as fh:
+        for row in df.itertuples(index=False):
+            fh.write(f'{row.perc:6.2f}\t{row.n_reads}\t'
+                     f'{row.n_reads_specific}\t{row.rank}\t{row.taxid}\t'
+                     f'{row.sciname}\n')
+
+
 def read_kraken2_results(path: str) -> pd.DataFrame:
     kraken2_fields = [('is_classified', 'category'),
                       ('readID', str),
@@ -74,3 +87,12 @@ def write_reads_seqtk(reads_path: str, names: Iterable[str],
     if not os.path.exists(output_path):
         raise FileNotFoundError(f'seqtk subseq did not output file at '
                                 f'"{output_path}" with command "{cmd}"')
+
+
+def open_reads(path: str) -> BinaryIO:
+    """Open a possibly Gzipped reads file for reading bytes"""
+    with open(path, 'rb') as fh:
+        magic = fh.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
@@ -0,0 +1,115 @@
+import logging
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from filter_classified_reads.bloom import ReadIdPrefilter
+from filter_classified_reads.io import write_kraken_report
+from filter_classified_reads.tax_node import TaxNode
+
+
+def filtered_read_taxids(df_results: pd.DataFrame,
+                         read_ids: Iterable[str],
+                         tax_tree: TaxNode) -> np.ndarray:
+    """Get the taxID of each filtered read from by read classification results.
+
+    Centrifuge may report multiple classifications (hits) for a read. As in
+    `centrifuge-kreport`, a read with multiple hits is assigned to the lowest
+    common ancestor (LCA) of its hits. Hits to taxa missing from the report
+    taxonomy tree (or with taxID 0) cannot be placed in the tree, so their
+    reads are assigned to the root to keep them in the report totals.
+    Centrifuge reads are unclassified if their seqID is "unclassified".
+
+    Args:
+        df_results: Kraken2 or Centrifuge classification results
+        read_ids: filtered read IDs
+        tax_tree: Taxonomy tree built from the original Kraken-style report
+    Returns:
+        taxID of each filtered read (0 for unclassified reads)
+    """
+    if isinstance(read_ids, ReadIdPrefilter):
+        df = df_results[read_ids.isin(df_results.index)]
+    else:
+        df = df_results[df_results.index.isin(list(read_ids))]
+    if df.empty:
+        return np.array([], dtype=np.int64)
+    groups, _ = pd.factorize(df.index)
+    taxids = df.taxID.values.astype(np.int64)
+    if 'seqID' in df.columns:
+        unclassified = (df.seqID == 'unclassified').values
+    else:
+        unclassified = taxids == 0
+    flat = tax_tree.flatten()
+    node_idx = flat.taxid_indexes(taxids)
+    # the root is the first node
+    lca = flat.group_lca(np.where(node_idx < 0, 0, node_idx), groups)
+    read_taxids = flat.taxids[lca]
+    n_reads = lca.size
+    read_unclassified = np.ones(n_reads, dtype=bool)
+    np.logical_and.at(read_unclassified, groups, unclassified)
+    read_taxids[read_unclassified] = 0
+    read_unknown = np.zeros(n_reads, dtype=bool)
+    np.logical_or.at(read_unknown, groups, (node_idx < 0) & ~unclassified)
+    n_unknown = int((read_unknown & ~read_unclassified).sum())
+    if n_unknown:
+        logging.warning(f'N={n_unknown} reads have classifications to taxa '
+                        f'not found in the report taxonomy tree and are '
+                        f'reported under the root')
+    return read_taxids
+
+
+def filtered_kreport(tax_tree: TaxNode,
+                     read_taxids: np.ndarray) -> pd.DataFrame:
+    """Build a Kraken-style report from the taxIDs of a subset of reads.
+
+    Reads are counted per taxonomy node with a bincount over node indexes and
+    clade counts are rolled up the tree one depth level at a time.
+
+    Args:
+        tax_tree: Taxonomy tree built from the original Kraken-style report
+        read_taxids: taxID of each read (0 for unclassified reads). Reads
+            with taxIDs not found in the tree are counted under the root.
+    Returns:
+        Kraken-style report DataFrame with only nodes with reads assigned
+    """
+    flat = tax_tree.flatten()
+    read_taxids = np.asarray(read_taxids, dtype=np.int64)
+    n_unclassified = int((read_taxids == 0).sum())
+    classified = read_taxids[read_taxids != 0]
+    node_idx = flat.taxid_indexes(classified)
+    n_unknown = int((node_idx < 0).sum())
+    if n_unknown:
+        logging.warning(f'N={n_unknown} reads have taxids not found in the '
+                        f'taxonomy tree and are reported under the root')
+    # the root is the first node
+    specific = np.bincount(np.where(node_idx < 0, 0, node_idx),
+                           minlength=len(flat))
+    clade = flat.rollup(specific)
+    total = n_unclassified + int(clade[0])
+    rows = []
+    if n_unclassified:
+        rows.append((n_unclassified, n_unclassified, 'U', 0, 'unclassified'))
+    for idx in np.flatnonzero(clade):
+        sciname = '  ' * int(flat.depths[idx]) + flat.names[idx]
+        rows.append((int(clade[idx]),
+                     int(specific[idx]),
+                     flat.ranks[idx],
+                     int(flat.taxids[idx]),
+                     sciname))
+    df = pd.DataFrame(rows, columns=['n_reads', 'n_reads_specific', 'rank',
+                                     'taxid', 'sciname'])
+    df.insert(0, 'perc', df.n_reads / total * 100.0 if total else 0.0)
+    return df
+
+
+def write_filtered_kreport(df_results: pd.DataFrame,
+                           df_kreport: pd.DataFrame,
+                           read_ids: Iterable[str],
+                           output_path: str) -> pd.DataFrame:
+    """Write a Kraken-style report for the filtered subset of reads."""
+    tax_tree = TaxNode.build_taxonomy_tree(df_kreport)
+    read_taxids = filtered_read_taxids(df_results, read_ids, tax_tree)
+    df = filtered_kreport(tax_tree, read_taxids)
+    write_kraken_report(df, output_path)
+    return df
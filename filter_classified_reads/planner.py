@@ -0,0 +1,537 @@
+import logging
+import os
+import shutil
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import attr
+import numpy as np
+
+from filter_classified_reads.bgzf import \
+    BGZF_BLOCK_SIZE, \
+    BGZF_MAGIC, \
+    BgzfReader
+from filter_classified_reads.bloom import CHUNK_SIZE
+from filter_classified_reads.const import BAM, FASTA, FASTQ, SAM
+from filter_classified_reads.fastq_index import \
+    BGZF, \
+    GZIP, \
+    PLAIN, \
+    default_index_path, \
+    fastq_compression
+from filter_classified_reads.formats import \
+    iter_bam_records, \
+    iter_fasta_records, \
+    iter_fastq_records, \
+    iter_sam_records, \
+    strip_mate_suffix
+from filter_classified_reads.io import open_reads
+from filter_classified_reads.read_filter import ReadFilter
+
+#: seqtk subseq with a hash table of read names (separate R1/R2 FASTQ/FASTA)
+SEQTK = 'seqtk'
+#: Python stream of reads with a hash set of read names
+HASH = 'hash'
+#: Python stream of reads merge-joined with classification results order
+MERGE = 'merge'
+#: Seek to reads by offset with a FASTQ index
+INDEX = 'index'
+#: Python stream of reads with a Bloom filter and on-disk read names
+BLOOM = 'bloom'
+strategies = [SEQTK, HASH, MERGE, INDEX, BLOOM]
+
+# Rough throughputs and per-item costs used to estimate the cost of each
+# strategy in seconds. Only relative costs matter.
+PLAIN_READ_RATE = 1e9
+GZIP_INFLATE_RATE = 3e8
+GZIP_DEFLATE_RATE = 3e7
+PY_RECORD_COST = 2e-6
+C_RECORD_COST = 2e-7
+HASH_LOOKUP_COST = 1e-7
+BLOOM_LOOKUP_COST = 3e-6
+SEEK_COST = 1e-4
+INDEX_BUILD_RECORD_COST = 3e-6
+# Estimated memory per read name held in a hash set/table beyond its length
+PY_SET_OVERHEAD = 90
+SEQTK_HASH_OVERHEAD = 40
+MERGE_OVERHEAD = 1
+BLOOM_BITS_PER_READ = 15
+# Max fraction of available memory a strategy may use
+MAX_MEMORY_FRACTION = 0.5
+# Fractions of reads files probed for classification results order besides
+# the start and the end
+PROBE_FRACTIONS = (0.25, 0.5, 0.75)
+# Min compressed bytes at the end of reads files probed
+PROBE_TAIL_BYTES = 1 << 17
+
+
+@attr.s
+class InputStats:
+    """Statistics of reads and classification results used for planning"""
+    fmt: str = attr.ib()
+    interleaved: bool = attr.ib()
+    compression: str = attr.ib()
+    n_files: int = attr.ib()
+    reads_bytes: int = attr.ib()
+    uncompressed_bytes: int = attr.ib()
+    n_reads: int = attr.ib()
+    n_kept: int = attr.ib()
+    mean_name_length: float = attr.ib()
+    results_in_reads_order: bool = attr.ib()
+    #: Reads order was checked beyond the start of the reads file
+    results_order_verified: bool = attr.ib()
+    has_index: bool = attr.ib()
+    seqtk_available: bool = attr.ib()
+    available_memory: Optional[int] = attr.ib()
+    n_cpus: int = attr.ib()
+
+    @property
+    def kept_fraction(self) -> float:
+        return self.n_kept / self.n_reads if self.n_reads else 1.0
+
+
+@attr.s
+class Plan:
+    """Chosen filtering strategy with estimated cost of each strategy
+
+    Costs are estimated seconds and memory in bytes. Strategies that cannot
+    be used with the inputs have no estimate.
+    """
+    strategy: str = attr.ib()
+    stats: InputStats = attr.ib()
+    costs: Dict[str, float] = attr.ib(factory=dict)
+    memory: Dict[str, int] = attr.ib(factory=dict)
+    reasons: Dict[str, str] = attr.ib(factory=dict)
+
+    def explain(self) -> str:
+        stats = self.stats
+        memory = f'{stats.available_memory / 1e9:.1f} GB' \
+            if stats.available_memory is not None else 'unknown'
+        verified = '' if stats.results_order_verified \
+            else ' (start of reads only, unverified)'
+        lines = [
+            f'Inputs: {stats.n_files} {stats.compression} {stats.fmt} '
+            f'file(s){" (interleaved)" if stats.interleaved else ""}, '
+            f'{stats.reads_bytes / 1e6:.1f} MB '
+            f'(~{stats.uncompressed_bytes / 1e6:.1f} MB uncompressed)',
+            f'Reads: ~{stats.n_reads} total, {stats.n_kept} kept '
+            f'({stats.kept_fraction:.2%})',
+            f'Classification results in reads order: '
+            f'{stats.results_in_reads_order}{verified}',
+            f'FASTQ index exists: {stats.has_index}; seqtk available: '
+            f'{stats.seqtk_available}',
+            f'Available memory: {memory}; CPUs: {stats.n_cpus}',
+            'Strategies:',
+        ]
+        for strategy in strategies:
+            marker = '*' if strategy == self.strategy else ' '
+            if strategy in self.costs:
+                reason = self.reasons.get(strategy)
+                lines.append(f' {marker} {strategy:<6} '
+                             f'cost~{self.costs[strategy]:.2f}s '
+                             f'memory~{self.memory[strategy] / 1e6:.1f} MB'
+                             f'{"; " + reason if reason else ""}')
+            else:
+                lines.append(f' {marker} {strategy:<6} not applicable: '
+                             f'{self.reasons.get(strategy, "")}')
+        lines.append(f'Chosen strategy: {self.strategy}')
+        return '\n'.join(lines)
+
+
+def _meminfo_available(path: str = '/proc/meminfo') -> Optional[int]:
+    """MemAvailable in bytes from /proc/meminfo (Linux)"""
+    try:
+        with open(path) as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _cgroup_memory_files(root: str = '/sys/fs/cgroup') \
+        -> List[Tuple[str, str]]:
+    """Memory limit and usage files of this process's cgroup (v2 then v1)"""
+    v2 = ''
+    v1 = ''
+    try:
+        with open('/proc/self/cgroup') as fh:
+            for line in fh:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                if controllers == '':
+                    v2 = path.lstrip('/')
+                elif 'memory' in controllers.split(','):
+                    v1 = path.lstrip('/')
+    except (OSError, ValueError):
+        pass
+    v2_dir = os.path.normpath(os.path.join(root, v2))
+    v1_dir = os.path.normpath(os.path.join(root, 'memory', v1))
+    files = []
+    for cgroup_dir in dict.fromkeys([v2_dir, root]):
+        files.append((os.path.join(cgroup_dir, 'memory.max'),
+                      os.path.join(cgroup_dir, 'memory.current')))
+    for cgroup_dir in dict.fromkeys([v1_dir, os.path.join(root, 'memory')]):
+        files.append((os.path.join(cgroup_dir, 'memory.limit_in_bytes'),
+                      os.path.join(cgroup_dir, 'memory.usage_in_bytes')))
+    return files
+
+
+def _cgroup_available() -> Optional[int]:
+    """Memory left under the cgroup v2 or v1 memory limit in bytes"""
+    for limit_path, usage_path in _cgroup_memory_files():
+        try:
+            with open(limit_path) as fh:
+                limit = fh.read().strip()
+            with open(usage_path) as fh:
+                usage = int(fh.read().strip())
+        except (OSError, ValueError):
+            continue
+        # no limit is "max" (v2) or a huge page-rounded number (v1)
+        if limit == 'max' or int(limit) >= 1 << 60:
+            continue
+        return max(0, int(limit) - usage)
+    return None
+
+
+def available_memory() -> Optional[int]:
+    """Available physical memory in bytes if it can be determined
+
+    Uses MemAvailable from /proc/meminfo (free memory plus reclaimable page
+    cache) or free physical pages if unavailable, capped by any cgroup
+    memory limit (e.g. in containers or batch jobs).
+    """
+    available = _meminfo_available()
+    if available is None:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') \
+                * os.sysconf('SC_PAGE_SIZE')
+        except (ValueError, OSError, AttributeError):
+            pass
+    cgroup = _cgroup_available()
+    if cgroup is not None:
+        available = cgroup if available is None else min(available, cgroup)
+    return available
+
+
+def cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def sample_reads(path: str,
+                 fmt: str,
+                 n: int = 1000) -> Tuple[List[bytes], int, int]:
+    """Sample read names from the start of a reads file
+
+    Returns:
+        tuple of sampled read names, compressed bytes and uncompressed bytes
+        read to get them
+    """
+    with open_reads(path) as fh:
+        # compressed bytes read are the position in the underlying file
+        raw = getattr(fh, 'fileobj', fh)
+        if fmt == BAM:
+            records = ((x[0], x[1]) for x in iter_bam_records(fh))
+        elif fmt == SAM:
+            records = ((x[0], x[1]) for x in iter_sam_records(fh))
+        elif fmt == FASTA:
+            records = iter_fasta_records(fh)
+        else:
+            records = iter_fastq_records(fh)
+        names: List[bytes] = []
+        n_bytes = 0
+        for name, record in records:
+            names.append(name)
+            n_bytes += len(record)
+            if len(names) >= n:
+                break
+        return names, raw.tell(), n_bytes
+
+
+def _bam_record_at(data: bytes, pos: int) -> Optional[Tuple[bytes, int]]:
+    """Name and end of a plausible BAM record at a position in a buffer"""
+    if pos + 36 > len(data):
+        return None
+    (block_size, ref_id) = struct.unpack_from('<ii', data, pos)
+    l_read_name = data[pos + 12]
+    end = pos + 4 + block_size
+    name_end = pos + 35 + l_read_name
+    if block_size < 32 + l_read_name or ref_id < -1 or l_read_name < 2 \
+            or name_end >= len(data) or data[name_end] != 0:
+        return None
+    name = data[pos + 36:name_end]
+    if not all(33 <= x <= 126 for x in name):
+        return None
+    return name, end
+
+
+def _probe_names(data: bytes, fmt: str) -> List[bytes]:
+    """Read names of the complete records in a buffer starting mid-file"""
+    lines = data.split(b'\n')[1:-1]
+    if fmt == FASTQ:
+        starts = (i for i in range(len(lines) - 2)
+                  if lines[i].startswith(b'@')
+                  and lines[i + 2].startswith(b'+'))
+        start = next(starts, len(lines))
+        return [strip_mate_suffix(lines[i][1:].split(None, 1)[0])
+                for i in range(start, len(lines) - 3, 4)]
+    if fmt == FASTA:
+        return [strip_mate_suffix(x[1:].split(None, 1)[0])
+                for x in lines if x.startswith(b'>')]
+    if fmt == SAM:
+        return [strip_mate_suffix(x.split(b'\t', 1)[0])
+                for x in lines if x and not x.startswith(b'@')]
+    names: List[bytes] = []
+    for pos in range(len(data)):
+        record = _bam_record_at(data, pos)
+        if record is not None and _bam_record_at(data, record[1]):
+            break
+    else:
+        return names
+    while record is not None and record[1] <= len(data):
+        names.append(strip_mate_suffix(record[0]))
+        record = _bam_record_at(data, record[1])
+    return names
+
+
+def probe_reads(path: str,
+                fmt: str,
+                offsets: Sequence[int],
+                n_bytes: int) -> List[List[bytes]]:
+    """Sample read names at byte offsets of an uncompressed or BGZF file
+
+    Reads are read from the first record or BGZF block after each offset.
+    Gzip (non-BGZF) files cannot be read from an offset without
+    decompressing everything before it, so they are not probed.
+
+    Args:
+        path: reads file path
+        fmt: reads file format
+        offsets: increasing compressed byte offsets
+        n_bytes: uncompressed bytes to read at each offset
+    Returns:
+        read names at each offset
+    Raises:
+        ValueError: if the file is Gzip but not BGZF compressed
+    """
+    compression = fastq_compression(path)
+    if compression not in (PLAIN, BGZF):
+        raise ValueError(f'Cannot probe {compression} compressed "{path}" '
+                         f'at byte offsets')
+    probes = []
+    with open(path, 'rb') as raw:
+        reader = BgzfReader(raw) if compression == BGZF else None
+        for offset in offsets:
+            raw.seek(offset)
+            if reader is None:
+                probes.append(_probe_names(raw.read(n_bytes), fmt))
+                continue
+            head = raw.read(BGZF_BLOCK_SIZE + 2 * len(BGZF_MAGIC))
+            block = head.find(BGZF_MAGIC)
+            while block >= 0 and head[block + 12:block + 14] != b'BC':
+                block = head.find(BGZF_MAGIC, block + 1)
+            if block < 0:
+                probes.append([])
+                continue
+            reader.seek((offset + block) << 16)
+            probes.append(_probe_names(reader.read(n_bytes), fmt))
+    return probes
+
+
+def _runs_in_order(ordered_names: np.ndarray,
+                   runs: Sequence[Sequence[str]]) -> bool:
+    """Check that runs of unique read names are contiguous in
+    `ordered_names` and start in the same order
+    """
+    start = 0
+    for run in runs:
+        if not run:
+            continue
+        hits = np.flatnonzero(ordered_names[start:] == run[0])
+        if hits.size == 0:
+            return False
+        start += int(hits[0])
+        if list(ordered_names[start:start + len(run)]) != list(run):
+            return False
+        start += 1
+    return True
+
+
+def gather_stats(read_filter: ReadFilter,
+                 reads1: str,
+                 reads2: Optional[str],
+                 fmt: str,
+                 interleaved: bool,
+                 n_sample: int = 1000,
+                 index_dir: Optional[str] = None) -> InputStats:
+    """Estimate read count, kept fraction, read order and compression
+
+    Reads are in classification results order if read names sampled from
+    the start of `reads1` are the first results and names probed at
+    `PROBE_FRACTIONS` and the end of `reads1` are later runs of results.
+    Gzip (non-BGZF) reads are only sampled at the start, which leaves the
+    order unverified, since probing would decompress nearly the whole file.
+    The merge-join falls back to a hash lookup on the first read out of
+    order.
+    """
+    paths = [x for x in (reads1, reads2) if x]
+    names, n_compressed, n_uncompressed = sample_reads(reads1, fmt, n_sample)
+    reads_bytes = sum(os.path.getsize(x) for x in paths)
+    ratio = n_uncompressed / n_compressed if n_compressed else 1.0
+    uncompressed_bytes = int(reads_bytes * ratio)
+    ordered_names = read_filter.results_names()
+    n_reads = len(ordered_names)
+    if n_reads == 0 and names:
+        n_reads = int(uncompressed_bytes / len(paths)
+                      / (n_uncompressed / len(names)))
+    if fmt == FASTQ:
+        compression = fastq_compression(reads1)
+    else:
+        compression = GZIP if ratio > 1.0 else PLAIN
+    paired = interleaved or fmt in (SAM, BAM)
+    sample = _unique_names(names, paired)
+    in_order = bool(sample) \
+        and list(ordered_names[:len(sample)]) == sample
+    size = os.path.getsize(reads1)
+    # reads out of order at the start or all sampled are verified
+    order_verified = not in_order or n_compressed >= size
+    if not order_verified and fastq_compression(reads1) in (PLAIN, BGZF):
+        offsets = [int(size * x) for x in PROBE_FRACTIONS]
+        tail_bytes = max(n_compressed, PROBE_TAIL_BYTES)
+        offsets.append(max(0, size - tail_bytes))
+        offsets = [x for x in sorted(set(offsets)) if x >= n_compressed]
+        probes = probe_reads(reads1, fmt, offsets, int(2 * tail_bytes * ratio))
+        in_order = _runs_in_order(ordered_names,
+                                  [_unique_names(x, paired) for x in probes])
+        order_verified = True
+    return InputStats(
+        fmt=fmt,
+        interleaved=interleaved,
+        compression=compression,
+        n_files=len(paths),
+        reads_bytes=reads_bytes,
+        uncompressed_bytes=uncompressed_bytes,
+        n_reads=n_reads,
+        n_kept=len(read_filter),
+        mean_name_length=(sum(len(x) for x in names) / len(names)
+                          if names else 20.0),
+        results_in_reads_order=in_order,
+        results_order_verified=order_verified,
+        has_index=all(os.path.exists(default_index_path(x, index_dir))
+                      for x in paths),
+        seqtk_available=shutil.which('seqtk') is not None,
+        available_memory=available_memory(),
+        n_cpus=cpu_count())
+
+
+def _unique_names(names: List[bytes], paired: bool) -> List[str]:
+    """Decode read names, merging adjacent mates of paired reads"""
+    decoded = [x.decode() for x in names]
+    if not paired:
+        return decoded
+    return [x for i, x in enumerate(decoded)
+            if i == 0 or x != decoded[i - 1]]
+
+
+def plan_filtering(stats: InputStats,
+                   strategy: Optional[str] = None,
+                   track_written: bool = False) -> Plan:
+    """Estimate the cost of each applicable strategy and pick the cheapest
+
+    Args:
+        stats: input statistics
+        strategy: force this strategy if applicable
+        track_written: written reads must be tracked (e.g. for provenance)
+            so seqtk cannot be used
+    Returns:
+        Plan with the cheapest strategy that fits in available memory
+    """
+    plan = Plan(strategy=HASH, stats=stats)
+    n_reads = stats.n_reads
+    n_kept = stats.n_kept
+    name_len = stats.mean_name_length
+    records_per_file = n_reads * (2 if stats.interleaved
+                                  or stats.fmt in (SAM, BAM) else 1)
+    n_records = records_per_file * stats.n_files
+    inflate = 0.0 if stats.compression == PLAIN \
+        else stats.uncompressed_bytes / GZIP_INFLATE_RATE
+    scan = inflate + stats.uncompressed_bytes / PLAIN_READ_RATE
+    out_bytes = stats.uncompressed_bytes * stats.kept_fraction
+    deflate = out_bytes / GZIP_DEFLATE_RATE
+    py_scan = scan + n_records * PY_RECORD_COST + deflate
+
+    if track_written:
+        plan.reasons[SEQTK] = 'cannot track written reads'
+    elif stats.seqtk_available and stats.fmt in (FASTQ, FASTA) \
+            and not stats.interleaved:
+        plan.costs[SEQTK] = scan \
+            + n_records * (C_RECORD_COST + HASH_LOOKUP_COST) \
+            + n_kept * stats.n_files * PY_RECORD_COST \
+            + deflate / max(1, stats.n_cpus)
+        plan.memory[SEQTK] = int(n_kept * (name_len * 2 + SEQTK_HASH_OVERHEAD
+                                           + PY_SET_OVERHEAD))
+    elif not stats.seqtk_available:
+        plan.reasons[SEQTK] = 'seqtk not found'
+    else:
+        plan.reasons[SEQTK] = 'only separate FASTQ/FASTA files supported'
+
+    plan.costs[HASH] = py_scan + n_records * HASH_LOOKUP_COST
+    plan.memory[HASH] = int(n_kept * (name_len + PY_SET_OVERHEAD) * 2)
+
+    if stats.results_in_reads_order:
+        plan.costs[MERGE] = py_scan
+        plan.memory[MERGE] = int(n_reads * MERGE_OVERHEAD
+                                 + n_kept * PY_SET_OVERHEAD)
+    else:
+        plan.reasons[MERGE] = 'classification results not in reads order'
+
+    if stats.fmt == FASTQ and not stats.interleaved \
+            and stats.compression in (PLAIN, BGZF):
+        n_seeks = n_kept * stats.n_files
+        if stats.compression == BGZF:
+            n_blocks = stats.uncompressed_bytes / BGZF_BLOCK_SIZE
+            blocks_read = min(n_blocks, n_seeks)
+            read_cost = blocks_read * (BGZF_BLOCK_SIZE / GZIP_INFLATE_RATE
+                                       + SEEK_COST)
+        else:
+            read_cost = min(n_seeks * SEEK_COST, scan) + out_bytes \
+                / PLAIN_READ_RATE
+        build = 0.0 if stats.has_index \
+            else py_scan + n_records * INDEX_BUILD_RECORD_COST
+        plan.costs[INDEX] = build + read_cost + n_seeks * PY_RECORD_COST \
+            + deflate
+        plan.memory[INDEX] = int(records_per_file * (name_len + 20)
+                                 + n_kept * (name_len + PY_SET_OVERHEAD))
+        if not stats.has_index:
+            plan.reasons[INDEX] = 'includes building index'
+    else:
+        plan.reasons[INDEX] = 'requires non-interleaved uncompressed or ' \
+                              'BGZF FASTQ'
+
+    plan.costs[BLOOM] = py_scan + n_records * BLOOM_LOOKUP_COST \
+        + n_kept * BLOOM_LOOKUP_COST
+    # Bloom filter bits plus one chunk of read IDs sorted in memory while
+    # building the on-disk read IDs
+    plan.memory[BLOOM] = int(n_kept * BLOOM_BITS_PER_READ / 8
+                             + min(n_kept, CHUNK_SIZE)
+                             * (name_len + PY_SET_OVERHEAD))
+
+    if strategy is not None:
+        if strategy not in plan.costs:
+            logging.warning(f'Strategy "{strategy}" cannot be used: '
+                            f'{plan.reasons.get(strategy)}. Choosing a '
+                            f'strategy automatically.')
+        else:
+            plan.strategy = strategy
+            return plan
+    memory_limit = stats.available_memory * MAX_MEMORY_FRACTION \
+        if stats.available_memory is not None else float('inf')
+    fits = {k: v for k, v in plan.costs.items()
+            if plan.memory[k] <= memory_limit}
+    if not fits:
+        fits = {BLOOM: plan.costs[BLOOM]}
+    plan.strategy = min(fits, key=fits.get)
+    return plan
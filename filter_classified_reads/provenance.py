@@ -0,0 +1,223 @@
+import logging
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from filter_classified_reads.bloom import ReadIdPrefilter
+from filter_classified_reads.const import CENTRIFUGE, KRAKEN2, VIRUSES_TAXID
+from filter_classified_reads.read_filter import ReadFilter
+from filter_classified_reads.target_classified_reads import \
+    common_unclassified_reads
+from filter_classified_reads.tax_node import TaxNode
+
+#: Rules that kept or dropped each read
+RULES = ['target_both',
+         'target_kraken2',
+         'target_centrifuge',
+         'unclassified',
+         'capped',
+         'unclassified_excluded',
+         'not_target']
+#: Whether mates of each read were written
+MATE_STATUSES = ['not_written', 'single', 'paired', 'mate1_only',
+                 'mate2_only']
+#: Columns stored as codes into a dictionary of values
+DICTIONARY_COLUMNS = {'read_id', 'rule', 'mate_status'}
+
+
+class WrittenReads:
+    """Record which mates of each read were written during the filtering pass
+
+    Written mates are flagged in a bitmap with one byte per read ID in the
+    sorted provenance read IDs (see `provenance_read_ids`) rather than by
+    keeping the names of written reads.
+    """
+    #: Bit flags of written reads and first and second mates
+    SINGLE = 1
+    MATE1 = 2
+    MATE2 = 4
+
+    def __init__(self, read_ids: np.ndarray):
+        self.read_ids = read_ids
+        self.flags = np.zeros(read_ids.size, dtype=np.uint8)
+
+    @classmethod
+    def for_filter(cls, read_filter: ReadFilter) -> 'WrittenReads':
+        return cls(provenance_read_ids(read_filter).values.astype(np.bytes_))
+
+    def observer(self, file_mate: int = 0) -> Callable[[bytes, int], None]:
+        """Get a function to pass as `on_write` to read writers
+
+        Args:
+            file_mate: mate number of reads written from a separate R1 (1)
+                or R2 (2) file, used if records have no mate number
+        """
+        bits = [self.SINGLE, self.MATE1, self.MATE2]
+        read_ids = self.read_ids
+        flags = self.flags
+
+        def on_write(name: bytes, mate: int) -> None:
+            i = read_ids.searchsorted(name)
+            if i < read_ids.size and read_ids[i] == name:
+                flags[i] |= bits[mate or file_mate]
+        return on_write
+
+    def mate_status(self) -> np.ndarray:
+        """Get MATE_STATUSES codes for the read IDs"""
+        mate1 = (self.flags & self.MATE1) > 0
+        mate2 = (self.flags & self.MATE2) > 0
+        return np.select(
+            [mate1 & mate2, mate1, mate2, (self.flags & self.SINGLE) > 0],
+            [MATE_STATUSES.index(x) for x in ['paired', 'mate1_only',
+                                              'mate2_only', 'single']],
+            MATE_STATUSES.index('not_written')).astype(np.uint8)
+
+
+def provenance_read_ids(read_filter: ReadFilter) -> pd.Index:
+    """Get the sorted unique IDs of all reads in the classification results"""
+    tcr = read_filter.tcr
+    indexes = [df.index for df in (tcr.kraken2_df_results,
+                                   tcr.centrifuge_df_results)
+               if df is not None]
+    read_ids = indexes[0]
+    for index in indexes[1:]:
+        read_ids = read_ids.append(index)
+    return read_ids.unique().sort_values()
+
+
+def target_taxid_map(read_filter: ReadFilter) -> Dict[int, int]:
+    """Map taxids to the most specific target taxid they are a descendant of
+
+    Targets may be nested (e.g. Viruses and Influenza A virus), in which case
+    descendants of the deeper target are mapped to it regardless of the
+    order of targets.
+    """
+    targets = read_filter.taxids or [VIRUSES_TAXID]
+    taxid_map: Dict[int, int] = {}
+    for method in (CENTRIFUGE, KRAKEN2):
+        df_kreport = getattr(read_filter.tcr, f'{method}_df_kreport')
+        if df_kreport is None:
+            continue
+        tax_tree = TaxNode.build_taxonomy_tree(df_kreport)
+        nodes = [(node, target) for node, target in
+                 ((tax_tree.search(x), x) for x in targets)
+                 if node is not None]
+        # deeper targets are mapped last to override their ancestors
+        for node, target in sorted(nodes, key=lambda x: x[0].spaces):
+            taxid_map.update((x, target) for x in node.taxids_set())
+    return taxid_map
+
+
+def _results_taxids(df: Optional[pd.DataFrame],
+                    read_ids: pd.Index,
+                    taxid_map: Dict[int, int]) -> np.ndarray:
+    """Get the taxid of each read preferring its first target classification
+
+    Reads may have more than one classification (e.g. Centrifuge multiple
+    hits), in which case the first classification to a target taxon or else
+    the first classification is used.
+    """
+    if df is None:
+        return np.zeros(len(read_ids), dtype=np.uint32)
+    is_target = df.taxID.isin(list(taxid_map)).values
+    taxids = df.taxID.iloc[np.argsort(~is_target, kind='stable')]
+    taxids = taxids[~taxids.index.duplicated(keep='first')]
+    return taxids.reindex(read_ids).fillna(0).values.astype(np.uint32)
+
+
+def build_provenance(read_filter: ReadFilter,
+                     written: WrittenReads) -> Dict[str, np.ndarray]:
+    """Build per-read provenance columns for all classified reads
+
+    Args:
+        read_filter: read filter used to write reads
+        written: reads written, created with `WrittenReads.for_filter`
+    Returns:
+        dict of column name to array. Dictionary encoded columns have codes
+        in `<column>` and values in `<column>_dictionary`.
+    """
+    tcr = read_filter.tcr
+    read_ids = provenance_read_ids(read_filter)
+    read_ids_bytes = written.read_ids
+    taxid_map = target_taxid_map(read_filter)
+    k2_taxids = _results_taxids(tcr.kraken2_df_results, read_ids, taxid_map)
+    c_taxids = _results_taxids(tcr.centrifuge_df_results, read_ids,
+                               taxid_map)
+    k2_target = read_ids.isin(list(tcr.kraken2_targets))
+    c_target = read_ids.isin(list(tcr.centrifuge_targets))
+    unclassified = read_ids.isin(list(common_unclassified_reads(tcr)))
+    if isinstance(read_filter.read_ids, ReadIdPrefilter):
+        kept = read_filter.read_ids.isin(read_ids_bytes)
+    else:
+        kept = read_ids.isin(read_filter.read_ids)
+    candidate = k2_target | c_target
+    if not read_filter.exclude_unclassified:
+        candidate |= unclassified
+    rule = np.select(
+        [kept & k2_target & c_target,
+         kept & k2_target,
+         kept & c_target,
+         kept & unclassified,
+         candidate,
+         unclassified],
+        [RULES.index(x) for x in RULES[:-1]],
+        RULES.index('not_target')).astype(np.uint8)
+    matched_taxids = np.where(k2_target, k2_taxids,
+                              np.where(c_target, c_taxids, 0))
+    target_taxids = pd.Series(matched_taxids) \
+        .map(taxid_map) \
+        .fillna(0) \
+        .values.astype(np.uint32)
+    return {
+        'read_id': np.arange(len(read_ids), dtype=np.uint32),
+        'read_id_dictionary': read_ids_bytes,
+        'kraken2_taxid': k2_taxids,
+        'centrifuge_taxid': c_taxids,
+        'target_taxid': target_taxids,
+        'rule': rule,
+        'rule_dictionary': np.array(RULES),
+        'mate_status': written.mate_status(),
+        'mate_status_dictionary': np.array(MATE_STATUSES),
+    }
+
+
+def write_provenance(read_filter: ReadFilter,
+                     written: WrittenReads,
+                     path: str) -> None:
+    """Write per-read provenance as compressed columnar arrays (npz)
+
+    Each column is stored as a separate compressed numpy array so columns
+    can be loaded and scanned independently. Read IDs, rules and mate
+    statuses are dictionary encoded.
+    """
+    columns = build_provenance(read_filter, written)
+    with open(path, 'wb') as fh:
+        np.savez_compressed(fh, **columns)
+    logging.info(f'Wrote provenance of n={columns["read_id"].size} reads to '
+                 f'"{path}"')
+
+
+def read_provenance(path: str,
+                    columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read per-read provenance into a DataFrame
+
+    Dictionary encoded columns are returned as categoricals.
+
+    Args:
+        path: provenance file written by `write_provenance`
+        columns: only read these columns (default: all)
+    """
+    data = {}
+    with np.load(path) as npz:
+        names = [x for x in npz.files if not x.endswith('_dictionary')]
+        for name in columns or names:
+            codes = npz[name]
+            if name in DICTIONARY_COLUMNS:
+                categories = npz[f'{name}_dictionary']
+                if categories.dtype.kind == 'S':
+                    categories = np.char.decode(categories)
+                data[name] = pd.Categorical.from_codes(codes, categories)
+            else:
+                data[name] = codes
+    return pd.DataFrame(data)
@@ -0,0 +1,276 @@
+import logging
+from itertools import chain
+from typing import \
+    Container, Iterable, Iterator, List, Optional, Tuple, Union
+
+import attr
+import numpy as np
+import pandas as pd
+
+from filter_classified_reads.bloom import ReadIdPrefilter
+from filter_classified_reads.const import CENTRIFUGE, KRAKEN2
+from filter_classified_reads.formats import \
+    iter_interleaved_pairs, \
+    iter_records
+from filter_classified_reads.sampling import cap_read_ids
+from filter_classified_reads.target_classified_reads import \
+    TargetClassifiedReads, \
+    common_unclassified_reads, \
+    find_target_read_ids
+from filter_classified_reads.util import compare_kraken2_and_centrifuge
+
+
+@attr.s
+class ReadFilter:
+    """Filter reads by Kraken2 and/or Centrifuge classification results
+
+    Filtered reads are streamed from the input reads so they can be passed
+    straight to downstream Python code without writing intermediate files.
+
+    Example:
+        >>> rf = ReadFilter.from_classifications(
+        ...     kraken2_results='kraken2_results.tsv',
+        ...     kraken2_kreport='kraken2_report.tsv')
+        >>> for name, record1, record2 in rf.iter_pairs('R1.fq', 'R2.fq'):
+        ...     pass
+    """
+    read_ids: Union[List[str], ReadIdPrefilter] = attr.ib()
+    tcr: TargetClassifiedReads = attr.ib(factory=TargetClassifiedReads)
+    taxids: Optional[List[int]] = attr.ib(default=None)
+    exclude_unclassified: bool = attr.ib(default=False)
+    _names: Optional[Container[bytes]] = attr.ib(default=None,
+                                                 init=False,
+                                                 repr=False)
+
+    @classmethod
+    def from_classifications(cls,
+                             kraken2_results: Optional[str] = None,
+                             kraken2_kreport: Optional[str] = None,
+                             centrifuge_results: Optional[str] = None,
+                             centrifuge_kreport: Optional[str] = None,
+                             taxids: Optional[List[int]] = None,
+                             exclude_unclassified: bool = False,
+                             max_reads_per_taxon: Optional[int] = None,
+                             cap_rank: Optional[str] = None,
+                             max_reads: Optional[int] = None,
+                             seed: int = 42,
+                             prefilter_path: Optional[str] = None,
+                             bloom_fpr: float = 0.001) -> 'ReadFilter':
+        """Find reads of target taxa from classification results and reports
+
+        Args:
+            kraken2_results: Kraken2 classification results
+            kraken2_kreport: Kraken2 report
+            centrifuge_results: Centrifuge classification results
+            centrifuge_kreport: Centrifuge Kraken-style report
+            taxids: Target NCBI Taxonomy IDs (default: Viruses)
+            exclude_unclassified: Do not keep unclassified reads
+            max_reads_per_taxon: max number of reads to keep per taxon
+            cap_rank: Cap reads per taxon at this rank
+            max_reads: max number of reads to keep in total
+            seed: random seed for capping reads
+            prefilter_path: Keep read IDs in a sorted on-disk array at this
+                path behind a Bloom filter to bound memory usage
+            bloom_fpr: Bloom filter false positive rate
+        Raises:
+            ValueError: if results are specified without a report or vice
+                versa or no classification results are specified
+        """
+        if bool(centrifuge_results) ^ bool(centrifuge_kreport):
+            raise ValueError('Both the Centrifuge results and Kraken-style '
+                             'report must be specified!')
+        if bool(kraken2_results) ^ bool(kraken2_kreport):
+            raise ValueError('Both the Kraken2 results and report must be '
+                             'specified!')
+        if not (centrifuge_results or kraken2_results):
+            raise ValueError('No Centrifuge or Kraken2 results and reports '
+                             'specified!')
+        tcr = TargetClassifiedReads()
+        if centrifuge_results and centrifuge_kreport:
+            tcr = find_target_read_ids(tcr=tcr,
+                                       kreport=centrifuge_kreport,
+                                       results=centrifuge_results,
+                                       method=CENTRIFUGE,
+                                       taxids=taxids)
+        if kraken2_results and kraken2_kreport:
+            tcr = find_target_read_ids(tcr=tcr,
+                                       kreport=kraken2_kreport,
+                                       results=kraken2_results,
+                                       method=KRAKEN2,
+                                       taxids=taxids)
+
+        target_read_ids = tcr.centrifuge_targets | tcr.kraken2_targets
+
+        unclassified_read_ids = common_unclassified_reads(tcr)
+        logging.info(f'Found N={len(unclassified_read_ids)} common '
+                     f'unclassified reads by all classification methods.')
+
+        compare_kraken2_and_centrifuge(centrifuge_results,
+                                       kraken2_results,
+                                       target_read_ids,
+                                       tcr)
+
+        read_id_sets = [target_read_ids]
+        if not exclude_unclassified:
+            read_id_sets.append(unclassified_read_ids)
+        read_ids: Union[Iterable[str], ReadIdPrefilter]
+        if max_reads_per_taxon is not None or max_reads is not None:
+            read_ids = cap_read_ids(tcr,
+                                    set().union(*read_id_sets),
+                                    max_reads_per_taxon=max_reads_per_taxon,
+                                    rank=cap_rank,
+                                    max_reads=max_reads,
+                                    seed=seed)
+        elif prefilter_path is not None:
+            read_ids = chain(*read_id_sets)
+        else:
+            # sorting in case that speeds up reading from FASTQ file
+            read_ids = sorted(set().union(*read_id_sets))
+        if prefilter_path is not None:
+            read_ids = ReadIdPrefilter.from_read_ids(read_ids,
+                                                     path=prefilter_path,
+                                                     fpr=bloom_fpr)
+        return cls(read_ids=read_ids,
+                   tcr=tcr,
+                   taxids=taxids,
+                   exclude_unclassified=exclude_unclassified)
+
+    def with_prefilter(self,
+                       path: str,
+                       bloom_fpr: float = 0.001) -> 'ReadFilter':
+        """Copy of this filter with read IDs in a memory-bounded prefilter"""
+        if isinstance(self.read_ids, ReadIdPrefilter):
+            return self
+        return attr.evolve(self, read_ids=ReadIdPrefilter.from_read_ids(
+            self.read_ids, path=path, fpr=bloom_fpr))
+
+    def results_names(self) -> np.ndarray:
+        """Get read names in classification results order
+
+        Results of the first classification method available are used with
+        only the first occurrence of each read.
+        """
+        for method in (KRAKEN2, CENTRIFUGE):
+            df = getattr(self.tcr, f'{method}_df_results')
+            if df is not None:
+                return df.index[~df.index.duplicated(keep='first')].values
+        return np.array([], dtype=object)
+
+    def results_order(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get read names in classification results order and whether each
+        read is kept by this filter
+
+        Read IDs in a prefilter are looked up in chunks rather than loaded
+        into a hash table.
+        """
+        names = self.results_names()
+        if isinstance(self.read_ids, ReadIdPrefilter):
+            keep = self.read_ids.isin(names)
+        else:
+            keep = pd.Index(names).isin(self.read_ids)
+        return names, keep
+
+    @property
+    def names(self) -> Container[bytes]:
+        """Read names as bytes for matching against read records"""
+        if self._names is None:
+            if isinstance(self.read_ids, ReadIdPrefilter):
+                self._names = self.read_ids
+            else:
+                self._names = {x.encode() for x in self.read_ids}
+        return self._names
+
+    def __len__(self) -> int:
+        return len(self.read_ids)
+
+    def __contains__(self, name: Union[str, bytes]) -> bool:
+        if isinstance(name, str):
+            name = name.encode()
+        return name in self.names
+
+    def iter_reads(self,
+                   reads_path: str,
+                   fmt: Optional[str] = None) -> Iterator[Tuple[bytes, bytes]]:
+        """Iterate over the name and raw bytes of each filtered read
+
+        Reads may be FASTQ, FASTA, SAM or BAM (detected if `fmt` is not
+        specified). Both mates of interleaved or paired SAM/BAM reads are
+        yielded.
+        """
+        names = self.names
+        for name, record, _ in iter_records(reads_path, fmt):
+            if name in names:
+                yield name, record
+
+    def iter_pairs(self,
+                   reads1: str,
+                   reads2: Optional[str] = None,
+                   fmt: Optional[str] = None) \
+            -> Iterator[Tuple[bytes, bytes, bytes]]:
+        """Iterate over the name and raw bytes of each filtered read pair
+
+        If `reads2` is not specified, mates are read from adjacent records of
+        interleaved FASTQ/FASTA or paired SAM/BAM `reads1`.
+
+        Raises:
+            ValueError: if the paired reads are not in the same order
+        """
+        names = self.names
+        if reads2 is None:
+            for name, record1, record2 in iter_interleaved_pairs(reads1, fmt):
+                if name in names:
+                    yield name, record1, record2
+            return
+        records2 = iter_records(reads2, fmt)
+        for name, record1, _ in iter_records(reads1, fmt):
+            name2, record2, _ = next(records2, (None, None, 0))
+            if name != name2:
+                raise ValueError(f'Paired reads out of sync: "{name}" in '
+                                 f'"{reads1}" but "{name2}" in "{reads2}"')
+            if name in names:
+                yield name, record1, record2
+        if next(records2, None) is not None:
+            raise ValueError(f'More reads in "{reads2}" than in "{reads1}"')
+
+    def iter_batches(self,
+                     reads_path: str,
+                     batch_size: int = 10000,
+                     fmt: Optional[str] = None) -> Iterator[memoryview]:
+        """Iterate over batches of concatenated filtered read records
+
+        Each batch is a memoryview over the raw bytes of up to `batch_size`
+        filtered records and is not reused by later batches.
+        """
+        batch = bytearray()
+        n = 0
+        for _, record in self.iter_reads(reads_path, fmt):
+            batch += record
+            n += 1
+            if n == batch_size:
+                yield memoryview(batch)
+                batch = bytearray()
+                n = 0
+        if n:
+            yield memoryview(batch)
+
+    def iter_pair_batches(self,
+                          reads1: str,
+                          reads2: Optional[str] = None,
+                          batch_size: int = 10000,
+                          fmt: Optional[str] = None) \
+            -> Iterator[Tuple[memoryview, memoryview]]:
+        """Iterate over batches of concatenated filtered read pair records"""
+        batch1 = bytearray()
+        batch2 = bytearray()
+        n = 0
+        for _, record1, record2 in self.iter_pairs(reads1, reads2, fmt):
+            batch1 += record1
+            batch2 += record2
+            n += 1
+            if n == batch_size:
+                yield memoryview(batch1), memoryview(batch2)
+                batch1 = bytearray()
+                batch2 = bytearray()
+                n = 0
+        if n:
+            yield memoryview(batch1), memoryview(batch2)
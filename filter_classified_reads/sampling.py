@@ -0,0 +1,148 @@
+import logging
+import random
+from collections import defaultdict
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+import pandas as pd
+
+from filter_classified_reads.const import CENTRIFUGE, KRAKEN2, RANK_CODES
+from filter_classified_reads.tax_node import TaxNode
+from filter_classified_reads.target_classified_reads import \
+    TargetClassifiedReads
+
+T = TypeVar('T')
+
+
+def reservoir_sample(items: Iterable[T],
+                     k: int,
+                     rng: random.Random) -> List[T]:
+    """Uniformly sample up to `k` items in a single pass (Algorithm R)."""
+    reservoir: List[T] = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+
+def reservoir_sample_groups(items: Iterable[Tuple[T, Hashable]],
+                            k: int,
+                            rng: random.Random) -> Dict[Hashable, List[T]]:
+    """Uniformly sample up to `k` items per group in a single pass.
+
+    Args:
+        items: (item, group) tuples
+        k: max number of items to keep per group
+        rng: seeded random number generator
+    Returns:
+        dict of group to sampled items
+    """
+    reservoirs: Dict[Hashable, List[T]] = defaultdict(list)
+    counts: Dict[Hashable, int] = defaultdict(int)
+    for item, group in items:
+        i = counts[group]
+        counts[group] = i + 1
+        if i < k:
+            reservoirs[group].append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                reservoirs[group][j] = item
+    return reservoirs
+
+
+def parse_rank(rank: str) -> str:
+    """Get Kraken-style report rank code from a rank name or code."""
+    return RANK_CODES.get(rank.lower(), rank)
+
+
+def read_taxids_series(tcr: TargetClassifiedReads) -> pd.Series:
+    """Get a taxID for each read from all classification results.
+
+    Kraken2 classifications are preferred over Centrifuge classifications
+    if a read is classified by both. Only the first Centrifuge
+    classification of a read is used.
+    """
+    read_taxids: Optional[pd.Series] = None
+    for method in (KRAKEN2, CENTRIFUGE):
+        df = getattr(tcr, f'{method}_df_results')
+        if df is None:
+            continue
+        taxids = df.taxID[~df.index.duplicated(keep='first')] \
+            .astype('int64')
+        if read_taxids is None:
+            read_taxids = taxids
+        else:
+            read_taxids = read_taxids.where(read_taxids != 0) \
+                .combine_first(taxids) \
+                .astype('int64')
+    if read_taxids is None:
+        return pd.Series([], dtype='int64')
+    return read_taxids
+
+
+def taxid_groups(tcr: TargetClassifiedReads, rank: str) -> Dict[int, int]:
+    """Map taxids to the taxid of their ancestor at `rank`"""
+    groups: Dict[int, int] = {}
+    for method in (CENTRIFUGE, KRAKEN2):
+        df_kreport = getattr(tcr, f'{method}_df_kreport')
+        if df_kreport is None:
+            continue
+        flat = TaxNode.build_taxonomy_tree(df_kreport).flatten()
+        groups.update(zip(flat.taxids.tolist(),
+                          flat.rank_ancestor_taxids(rank).tolist()))
+    return groups
+
+
+def cap_read_ids(tcr: TargetClassifiedReads,
+                 read_ids: Iterable[str],
+                 max_reads_per_taxon: Optional[int] = None,
+                 rank: Optional[str] = None,
+                 max_reads: Optional[int] = None,
+                 seed: int = 42) -> List[str]:
+    """Cap the number of reads per taxon and/or in total by reservoir sampling
+
+    Paired reads share a read ID so mates are always kept together.
+    Unclassified reads are capped as a single group with taxid 0.
+
+    Args:
+        tcr: Target classified reads with classification results
+        read_ids: read IDs to sample from
+        max_reads_per_taxon: max number of reads to keep per taxon
+        rank: Cap reads per taxon at this rank (e.g. "species" or "S")
+            rather than per classified taxon
+        max_reads: max number of reads to keep in total
+        seed: random seed
+    Returns:
+        sorted list of sampled read IDs
+    """
+    rng = random.Random(seed)
+    read_ids = sorted(read_ids)
+    if max_reads_per_taxon is not None:
+        read_taxids = read_taxids_series(tcr) \
+            .reindex(read_ids) \
+            .fillna(0) \
+            .astype('int64')
+        if rank:
+            rank = parse_rank(rank)
+            groups = taxid_groups(tcr, rank)
+            read_taxids = read_taxids.map(groups) \
+                .fillna(read_taxids) \
+                .astype('int64')
+        reservoirs = reservoir_sample_groups(zip(read_ids, read_taxids.values),
+                                             max_reads_per_taxon,
+                                             rng)
+        n_groups = len(reservoirs)
+        read_ids = sorted(x for xs in reservoirs.values() for x in xs)
+        logging.info(f'Kept n={len(read_ids)} reads after capping to at most '
+                     f'{max_reads_per_taxon} reads for each of '
+                     f'{n_groups} taxa'
+                     f'{f" at rank {rank}" if rank else ""}')
+    if max_reads is not None and len(read_ids) > max_reads:
+        read_ids = sorted(reservoir_sample(read_ids, max_reads, rng))
+        logging.info(f'Kept n={len(read_ids)} reads after capping total '
+                     f'reads to {max_reads}')
+    return read_ids
@@ -20,9 +20,11 @@ class TargetClassifiedReads:
     centrifuge_targets: Set[str] = attr.ib(factory=set)
     centrifuge_unclassified: Optional[Set[str]] = attr.ib(default=None)
     centrifuge_df_results: Optional[pd.DataFrame] = attr.ib(default=None)
+    centrifuge_df_kreport: Optional[pd.DataFrame] = attr.ib(default=None)
     kraken2_targets: Set[str] = attr.ib(factory=set)
     kraken2_unclassified: Optional[Set[str]] = attr.ib(default=None)
     kraken2_df_results: Optional[pd.DataFrame] = attr.ib(default=None)
+    kraken2_df_kreport: Optional[pd.DataFrame] = attr.ib(default=None)
 
 
 def common_unclassified_reads(tcr: TargetClassifiedReads) -> Set[str]:
@@ -60,6 +62,7 @@ def find_target_read_ids(tcr: TargetClassifiedReads,
     logging.info(f'Parsed n={df_kreport.shape[0]} {method} '
                  f'Kraken-style report records into DataFrame from '
                  f'"{kreport}"')
+    tcr.__dict__[f'{method}_df_kreport'] = df_kreport
     df_unclassified = subset_unclassified(df_results)
     unclassified_read_ids = set(df_unclassified.index)
     logging.info(f'Found {len(unclassified_read_ids)} unclassified reads from '
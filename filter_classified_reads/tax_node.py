@@ -2,12 +2,99 @@ from collections.__init__ import defaultdict
 from typing import Optional, List, Mapping, Iterator, Set
 
 import attr
+import numpy as np
 import pandas as pd
 
 from filter_classified_reads.const import VIRUSES_TAXID
 from filter_classified_reads.util import prefix_spaces
 
 
+@attr.s
+class FlatTaxonomy:
+    """Taxonomy tree flattened into preorder arrays.
+
+    `parents` holds the index of the parent of each node (-1 for the root)
+    and `depths` the number of levels below the root.
+    """
+    taxids: np.ndarray = attr.ib()
+    parents: np.ndarray = attr.ib()
+    depths: np.ndarray = attr.ib()
+    ranks: List[str] = attr.ib()
+    names: List[str] = attr.ib()
+
+    def __len__(self) -> int:
+        return self.taxids.size
+
+    def taxid_indexes(self, taxids: np.ndarray) -> np.ndarray:
+        """Map taxids to node indexes; -1 for taxids not in the tree."""
+        taxids = np.asarray(taxids, dtype=np.int64)
+        order = np.argsort(self.taxids, kind='stable')
+        sorted_taxids = self.taxids[order]
+        pos = np.searchsorted(sorted_taxids, taxids)
+        pos[pos == sorted_taxids.size] = 0
+        found = sorted_taxids[pos] == taxids
+        return np.where(found, order[pos], -1)
+
+    def rollup(self, counts: np.ndarray) -> np.ndarray:
+        """Cumulative sum of per-node counts from the leaves up to the root.
+
+        Nodes are summed into their parents one depth level at a time so
+        there is no per-node Python recursion.
+        """
+        clade = counts.astype(np.int64, copy=True)
+        for depth in range(int(self.depths.max(initial=0)), 0, -1):
+            idx = np.flatnonzero(self.depths == depth)
+            np.add.at(clade, self.parents[idx], clade[idx])
+        return clade
+
+    def group_lca(self,
+                  node_idx: np.ndarray,
+                  groups: np.ndarray) -> np.ndarray:
+        """Lowest common ancestor node index of each group of nodes.
+
+        Deeper nodes of each group are moved up to their parents until all
+        nodes of the group are at the same depth and then all nodes are moved
+        up together until they are the same node.
+
+        Args:
+            node_idx: node index of each item
+            groups: group number (0 to n_groups - 1) of each item
+        """
+        idx = np.asarray(node_idx, dtype=np.int64).copy()
+        groups = np.asarray(groups, dtype=np.int64)
+        n_groups = int(groups.max(initial=-1)) + 1
+        while True:
+            depths = self.depths[idx]
+            min_depth = np.full(n_groups, np.iinfo(np.int64).max)
+            np.minimum.at(min_depth, groups, depths)
+            deeper = depths > min_depth[groups]
+            if deeper.any():
+                idx[deeper] = self.parents[idx[deeper]]
+                continue
+            lowest = np.full(n_groups, np.iinfo(np.int64).max)
+            highest = np.full(n_groups, -1)
+            np.minimum.at(lowest, groups, idx)
+            np.maximum.at(highest, groups, idx)
+            differ = lowest[groups] != highest[groups]
+            if not differ.any():
+                return lowest
+            idx[differ] = self.parents[idx[differ]]
+
+    def rank_ancestor_taxids(self, rank: str) -> np.ndarray:
+        """Taxid of the closest ancestor (or self) of each node at a rank.
+
+        Nodes without an ancestor at `rank` (e.g. nodes above it) get their
+        own taxid.
+        """
+        ancestors = np.where(np.array(self.ranks) == rank,
+                             np.arange(len(self)), -1)
+        for depth in range(1, int(self.depths.max(initial=0)) + 1):
+            idx = np.flatnonzero((self.depths == depth) & (ancestors < 0))
+            ancestors[idx] = ancestors[self.parents[idx]]
+        ancestors = np.where(ancestors < 0, np.arange(len(self)), ancestors)
+        return self.taxids[ancestors]
+
+
 @attr.s
 class TaxNode:
     parent: Optional['TaxNode'] = attr.ib(default=None)
@@ -26,7 +113,10 @@ class TaxNode:
         nodes[0] += [root_node]
         for idx, row in df_kreport.iterrows():
             sciname = row.sciname
-            if sciname in ['unclassified', 'root']:
+            if sciname == 'root':
+                root_node.rank = row['rank']
+                continue
+            if sciname == 'unclassified':
                 continue
             spaces = prefix_spaces(sciname)
             # print(sciname, spaces)
@@ -56,6 +146,30 @@ class TaxNode:
             if len(child.children) > 0:
                 yield from child.iter_children()
 
+    def flatten(self) -> FlatTaxonomy:
+        """Flatten this node and its descendants into preorder arrays."""
+        taxids: List[int] = []
+        parents: List[int] = []
+        depths: List[int] = []
+        ranks: List[str] = []
+        names: List[str] = []
+        stack = [(self, -1, 0)]
+        while stack:
+            node, parent_idx, depth = stack.pop()
+            idx = len(taxids)
+            taxids.append(node.taxid if node.taxid is not None else -1)
+            parents.append(parent_idx)
+            depths.append(depth)
+            ranks.append(node.rank if node.rank is not None else '-')
+            names.append(node.name if node.name is not None else '')
+            for child in reversed(node.children):
+                stack.append((child, idx, depth + 1))
+        return FlatTaxonomy(taxids=np.array(taxids, dtype=np.int64),
+                            parents=np.array(parents, dtype=np.int64),
+                            depths=np.array(depths, dtype=np.int64),
+                            ranks=ranks,
+                            names=names)
+
     def viral_tax_node(self: 'TaxNode') -> Optional['TaxNode']:
         # superkingdom, viruses: https://www.ncbi.nlm.nih.gov/taxonomy/10239
         return self.search(VIRUSES_TAXID)
@@ -3,15 +3,67 @@
 
 """Tests for `filter_classified_reads` package."""
 import os
+import struct
+import subprocess
+import sys
 
+import attr
+import numpy as np
+import pandas as pd
+import pytest
 from click.testing import CliRunner
 
-from filter_classified_reads.const import VIRUSES_TAXID
-from filter_classified_reads import cli
+from filter_classified_reads.bgzf import BgzfWriter, is_bgzf
+from filter_classified_reads.const import \
+    BAM, \
+    FASTA, \
+    FASTQ, \
+    KRAKEN2, \
+    SAM, \
+    VIRUSES_TAXID
+from filter_classified_reads import cli, fastq_index, planner
 from filter_classified_reads.target_classified_reads import \
     common_unclassified_reads, \
+    find_target_read_ids, \
     TargetClassifiedReads
-from filter_classified_reads.io import read_kraken_report
+from filter_classified_reads.bloom import ReadIdPrefilter
+from filter_classified_reads.fastq_index import \
+    GZIP, \
+    FastqIndex, \
+    default_index_path, \
+    write_reads_indexed
+from filter_classified_reads.formats import \
+    detect_format, \
+    detect_interleaved, \
+    iter_records, \
+    read_header, \
+    write_filtered_records, \
+    write_records_merge_join
+from filter_classified_reads.io import \
+    read_centrifuge_results, \
+    read_kraken_report, \
+    read_kraken2_results
+from filter_classified_reads.kreport import \
+    filtered_kreport, \
+    filtered_read_taxids
+from filter_classified_reads.planner import \
+    BLOOM, \
+    HASH, \
+    INDEX, \
+    MERGE, \
+    SEQTK, \
+    InputStats, \
+    gather_stats, \
+    plan_filtering
+from filter_classified_reads.provenance import \
+    MATE_STATUSES, \
+    WrittenReads, \
+    read_provenance, \
+    target_taxid_map
+from filter_classified_reads.read_filter import ReadFilter
+from filter_classified_reads.sampling import \
+    cap_read_ids, \
+    read_taxids_series
 from filter_classified_reads.tax_node import TaxNode
 
 r1 = os.path.abspath(
@@ -101,3 +153,456 @@ def test_command_line_interface():
         assert count_lines(out1) > 4
         assert os.path.exists(out2)
         assert count_lines(out2) > 4
+
+
+def test_filtered_kreport():
+    df_k2_kreport = read_kraken_report(k2_report)
+    df_k2_results = read_kraken2_results(k2_results)
+    tax_tree = TaxNode.build_taxonomy_tree(df_k2_kreport)
+    df = filtered_kreport(tax_tree, df_k2_results.taxID.values)
+    df_expected = df_k2_kreport[df_k2_kreport.n_reads > 0]
+    assert list(df.taxid) == list(df_expected.taxid), \
+        'Report of all reads must have the same taxa in the same order as ' \
+        'the original report'
+    assert list(df.n_reads) == list(df_expected.n_reads), \
+        'Clade read counts must match the original report'
+    assert list(df.n_reads_specific) == list(df_expected.n_reads_specific), \
+        'Taxon specific read counts must match the original report'
+    assert list(df.sciname) == list(df_expected.sciname), \
+        'Scientific names must be indented as in the original report'
+    df_viral = filtered_kreport(tax_tree, [0, 0, 11320])
+    assert df_viral.set_index('taxid').n_reads.to_dict()[VIRUSES_TAXID] == 1
+    assert df_viral.n_reads.iloc[0] == 2, \
+        'Unclassified reads must be reported first'
+
+
+def test_filtered_kreport_centrifuge(tmpdir):
+    df_c_kreport = read_kraken_report(c_report)
+    df_c_results = read_centrifuge_results(c_results)
+    tax_tree = TaxNode.build_taxonomy_tree(df_c_kreport)
+    read_taxids = filtered_read_taxids(df_c_results,
+                                       df_c_results.index.unique(),
+                                       tax_tree)
+    assert read_taxids.size == df_c_results.index.nunique()
+    prefilter = ReadIdPrefilter.from_read_ids(df_c_results.index,
+                                              path=str(tmpdir / 'ids.bin'))
+    assert (filtered_read_taxids(df_c_results, prefilter, tax_tree)
+            == read_taxids).all()
+    df = filtered_kreport(tax_tree, read_taxids).set_index('taxid')
+    df_expected = df_c_kreport.set_index('taxid')
+    for taxid in [0, 1]:
+        assert df.n_reads[taxid] == df_expected.n_reads[taxid], \
+            'Unclassified and root counts must match the original report'
+        assert round(df.perc[taxid], 2) == df_expected.perc[taxid]
+    assert (df.n_reads <= df_expected.n_reads.reindex(df.index)).all(), \
+        'Reads must not be reported under taxa they may not belong to'
+    strains = [1731514, 1737274]
+    lca = tax_tree.search(strains[0]).parent
+    df_multi = pd.DataFrame({'seqID': ['a', 'b', 'c'],
+                             'taxID': strains + [9999999]},
+                            index=['r1', 'r1', 'r2'])
+    assert list(filtered_read_taxids(df_multi, ['r1', 'r2'], tax_tree)) \
+        == [lca.taxid, 1], \
+        'Multi-hit reads must be assigned to the LCA of their hits and ' \
+        'reads with hits not in the report to the root'
+
+
+def test_cap_read_ids():
+    tcr = find_target_read_ids(tcr=TargetClassifiedReads(),
+                               kreport=k2_report,
+                               results=k2_results,
+                               method=KRAKEN2)
+    read_ids = tcr.kraken2_targets | tcr.kraken2_unclassified
+    capped = cap_read_ids(tcr, read_ids, max_reads_per_taxon=10)
+    assert capped == sorted(capped), 'Capped read IDs must be sorted'
+    assert set(capped) <= read_ids
+    read_taxids = read_taxids_series(tcr).reindex(capped)
+    assert read_taxids.value_counts().max() == 10, \
+        'There must be at most 10 reads per taxon'
+    assert capped == cap_read_ids(tcr, read_ids, max_reads_per_taxon=10), \
+        'Sampling must be reproducible with the same seed'
+    capped_species = cap_read_ids(tcr, read_ids,
+                                  max_reads_per_taxon=10,
+                                  rank='species')
+    assert len(capped_species) < len(capped), \
+        'Capping at species rank must group subspecies taxa together'
+    assert len(cap_read_ids(tcr, read_ids, max_reads=5)) == 5
+    assert len(cap_read_ids(tcr, read_ids,
+                            max_reads_per_taxon=10,
+                            max_reads=5)) == 5
+
+
+def test_read_id_prefilter(tmpdir):
+    read_ids = [name for name, *_ in iter_records(r1)]
+    kept = set(read_ids[::3])
+    prefilter = ReadIdPrefilter.from_read_ids(kept,
+                                              path=str(tmpdir / 'ids.bin'),
+                                              fpr=0.01)
+    assert len(prefilter) == len(kept)
+    assert {x.encode() for x in prefilter} == kept
+    assert all(x in prefilter for x in kept), \
+        'Bloom filter prefilter must not have false negatives'
+    assert not any(x in prefilter for x in read_ids if x not in kept), \
+        'False positives must be removed by the on-disk read ID lookup'
+    assert read_ids[0].decode() in prefilter, 'Must accept str read IDs'
+    assert (read_ids[0] + b'x' * 100) not in prefilter
+    assert list(prefilter.isin(read_ids + [read_ids[0] + b'x' * 100])) == \
+        [x in kept for x in read_ids] + [False]
+    out = str(tmpdir / 'out.fq.gz')
+    assert write_filtered_records(r1, prefilter, out) == len(kept)
+    assert count_lines(out) == len(kept) * 4
+
+
+def test_read_filter(tmpdir):
+    read_filter = ReadFilter.from_classifications(
+        kraken2_results=k2_results,
+        kraken2_kreport=k2_report,
+        centrifuge_results=c_results,
+        centrifuge_kreport=c_report,
+        exclude_unclassified=True)
+    assert len(read_filter) > 0
+    assert read_filter.read_ids == sorted(read_filter.read_ids)
+    assert all(x in read_filter for x in read_filter.read_ids)
+    reads = list(read_filter.iter_reads(r1))
+    assert len(reads) == len(read_filter), \
+        'All filtered reads must be found in the reads file'
+    assert all(record.startswith(b'@' + name) for name, record in reads)
+    pairs = list(read_filter.iter_pairs(r1, r2))
+    assert [name for name, *_ in pairs] == [name for name, _ in reads]
+    batches = list(read_filter.iter_pair_batches(r1, r2, batch_size=1000))
+    assert len(batches) == -(-len(reads) // 1000)
+    assert b''.join(bytes(b1) for b1, _ in batches) == \
+        b''.join(record for _, record in reads)
+    assert b''.join(bytes(b2) for _, b2 in batches) == \
+        b''.join(record2 for _, _, record2 in pairs)
+    names, keep = read_filter.results_order()
+    assert keep.sum() == len(read_filter)
+    prefiltered = read_filter.with_prefilter(str(tmpdir / 'ids.bin'))
+    assert (prefiltered.results_order()[1] == keep).all()
+    with pytest.raises(ValueError):
+        ReadFilter.from_classifications(kraken2_results=k2_results)
+
+
+def bam_record(name: bytes, seq: bytes, qual: bytes, flag: int) -> bytes:
+    """Encode an unaligned BAM record"""
+    codes = b'=ACMGRSVTWYHKDBN'
+    packed = bytes((codes.index(seq[i]) << 4)
+                   | (codes.index(seq[i + 1]) if i + 1 < len(seq) else 0)
+                   for i in range(0, len(seq), 2))
+    data = struct.pack('<iiBBHHHiiii', -1, -1, len(name) + 1, 0, 4680, 0,
+                       flag, len(seq), -1, -1, 0) \
+        + name + b'\0' + packed + bytes(x - 33 for x in qual)
+    return struct.pack('<i', len(data)) + data
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7),
+                    reason='module __getattr__ requires Python 3.7')
+def test_package_imports_read_filter_lazily():
+    code = ('import sys, filter_classified_reads as fcr; '
+            'assert "pandas" not in sys.modules; '
+            'from filter_classified_reads import ReadFilter; '
+            'assert "pandas" in sys.modules; '
+            'assert fcr.ReadFilter is ReadFilter')
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+def test_read_formats(tmpdir):
+    pairs = list(zip(iter_records(r1), iter_records(r2)))[:100]
+    interleaved = str(tmpdir / 'interleaved.fq')
+    fasta = str(tmpdir / 'reads.fa')
+    sam = str(tmpdir / 'reads.sam')
+    bam = str(tmpdir / 'reads.bam')
+    sam_header = b'@HD\tVN:1.6\tSO:unsorted\n'
+    with open(interleaved, 'wb') as fq, open(fasta, 'wb') as fa, \
+            open(sam, 'wb') as fsam, BgzfWriter.open(bam) as fbam:
+        fsam.write(sam_header)
+        fbam.write(b'BAM\x01' + struct.pack('<i', len(sam_header))
+                   + sam_header + struct.pack('<i', 0))
+        for (name, rec1, _), (_, rec2, _) in pairs:
+            for i, rec in enumerate([rec1, rec2]):
+                header, seq, _, qual = rec.split(b'\n')[:4]
+                flag = 77 if i == 0 else 141
+                fq.write(header.split()[0] + f'/{i + 1}\n'.encode()
+                         + b'\n'.join([seq, b'+', qual]) + b'\n')
+                fa.write(b'>' + name + b'\n' + seq[:60] + b'\n'
+                         + seq[60:] + b'\n')
+                qname = name + f'/{i + 1}'.encode()
+                fsam.write(b'\t'.join([qname, str(flag).encode(), b'*', b'0',
+                                       b'0', b'*', b'*', b'0', b'0', seq,
+                                       qual]) + b'\n')
+                fbam.write(bam_record(qname, seq, qual, flag))
+    kept = {name for (name, *_), _ in pairs[::4]}
+    for path, fmt in [(interleaved, FASTQ), (fasta, FASTA), (sam, SAM),
+                      (bam, BAM)]:
+        assert detect_format(path) == fmt
+        is_interleaved = detect_interleaved(path, fmt)
+        assert is_interleaved == (fmt in (FASTQ, FASTA))
+        out1 = str(tmpdir / f'out1.{fmt}')
+        out2 = str(tmpdir / f'out2.{fmt}')
+        n = write_filtered_records(path, kept, out1, out2,
+                                   interleaved=is_interleaved)
+        assert n == len(kept) * 2, 'Both mates of kept pairs must be written'
+        assert is_bgzf(out1) == (fmt != SAM), \
+            'FASTQ/FASTA output must be BGZF compressed like seqtk+pbgzip'
+        mates1 = list(iter_records(out1))
+        mates2 = list(iter_records(out2))
+        assert [x[0] for x in mates1] == [x[0] for x in mates2] \
+            == sorted(kept, key=[x[0][0] for x in pairs].index)
+        if fmt in (SAM, BAM):
+            assert all(mate == 1 for *_, mate in mates1)
+            assert all(mate == 2 for *_, mate in mates2)
+            assert read_header(out1, fmt) == read_header(path, fmt)
+        read_filter = ReadFilter(read_ids=sorted(x.decode() for x in kept))
+        assert [x[0] for x in read_filter.iter_pairs(path)] == \
+            [x[0] for x in mates1]
+
+
+def test_fastq_blank_and_truncated_records(tmpdir):
+    records = [record for _, record, _ in iter_records(r1)][:10]
+    blank = str(tmpdir / 'blank.fq')
+    truncated = str(tmpdir / 'truncated.fq')
+    with open(blank, 'wb') as fout:
+        fout.write(b''.join(records[:5]) + b'\n' + b''.join(records[5:])
+                   + b'\n\n')
+    with open(truncated, 'wb') as fout:
+        fout.write(b''.join(records) + records[0].split(b'\n')[0] + b'\n')
+    assert [x[1] for x in iter_records(blank)] == records, \
+        'Blank lines between FASTQ records must be skipped'
+    assert len(FastqIndex.build(blank)) == len(records)
+    with pytest.raises(ValueError):
+        list(iter_records(truncated))
+    with pytest.raises(ValueError):
+        FastqIndex.build(truncated)
+
+
+def test_fastq_index(tmpdir, monkeypatch):
+    records = list(iter_records(r1))
+    plain = str(tmpdir / 'reads.fq')
+    bgzf = str(tmpdir / 'reads.fq.gz')
+    with open(plain, 'wb') as fout, BgzfWriter.open(bgzf) as fbgzf:
+        for _, record, _ in records:
+            fout.write(record)
+            fbgzf.write(record)
+    kept = [name for name, *_ in records[::50]] + [b'missing']
+    expected = [record for _, record, _ in records[::50]]
+    with pytest.raises(ValueError):
+        FastqIndex.build(r1)
+    for path in [plain, bgzf]:
+        index = FastqIndex.for_reads(path)
+        assert len(index) == len(records)
+        assert os.path.exists(default_index_path(path))
+        assert FastqIndex.for_reads(path).compression == index.compression
+        assert list(index.iter_records(path, reversed(kept))) == expected, \
+            'Indexed records must be returned in FASTQ order'
+        out = str(tmpdir / 'out.fq.gz')
+        assert write_reads_indexed(path, index, kept, out) == len(expected)
+        assert count_lines(out) == len(expected) * 4
+    monkeypatch.setattr(fastq_index, 'MAX_BATCH_BYTES', 1000)
+    kept = [name for name, *_ in records[:100]]
+    index = FastqIndex.for_reads(plain)
+    assert list(index.iter_records(plain, kept)) == \
+        [record for _, record, _ in records[:100]], \
+        'Dense records must be read in batches of limited size'
+    index_dir = str(tmpdir / 'indexes')
+    os.mkdir(index_dir)
+    FastqIndex.for_reads(plain, index_dir)
+    assert os.path.exists(default_index_path(plain, index_dir))
+    missing_dir = str(tmpdir / 'missing')
+    index = FastqIndex.for_reads(plain, missing_dir)
+    assert len(index) == len(records), \
+        'Index must be kept in memory if it cannot be saved'
+
+
+def test_write_records_merge_join(tmpdir):
+    records = list(iter_records(r1))
+    ordered_names = [name.decode() for name, *_ in records]
+    keep = [i % 3 == 0 for i in range(len(records))]
+    out = str(tmpdir / 'out.fq.gz')
+    n = write_records_merge_join(r1, ordered_names, keep, out)
+    assert n == sum(keep)
+    assert [x[0] for x in iter_records(out)] == \
+        [name for (name, *_), k in zip(records, keep) if k]
+    with pytest.raises(ValueError):
+        write_records_merge_join(r1, ordered_names[::-1], keep, out)
+
+
+def test_plan_filtering():
+    stats = InputStats(fmt=FASTQ,
+                       interleaved=False,
+                       compression='bgzf',
+                       n_files=2,
+                       reads_bytes=int(10e9),
+                       uncompressed_bytes=int(40e9),
+                       n_reads=int(100e6),
+                       n_kept=int(50e3),
+                       mean_name_length=20.0,
+                       results_in_reads_order=False,
+                       results_order_verified=True,
+                       has_index=True,
+                       seqtk_available=True,
+                       available_memory=int(16e9),
+                       n_cpus=4)
+    assert plan_filtering(stats).strategy == INDEX, \
+        'Seeking with an existing index is cheapest for sparse targets'
+    dense = attr.evolve(stats, n_kept=int(20e6), compression=GZIP)
+    assert plan_filtering(dense).strategy == SEQTK
+    assert plan_filtering(attr.evolve(dense, results_in_reads_order=True,
+                                      seqtk_available=False)).strategy \
+        == MERGE
+    low_memory = attr.evolve(dense, available_memory=int(1e9))
+    assert plan_filtering(low_memory).strategy == BLOOM
+    assert plan_filtering(dense, HASH).strategy == HASH
+    assert plan_filtering(dense, INDEX).strategy != INDEX, \
+        'Gzipped FASTQ cannot be indexed'
+    assert 'Chosen strategy: seqtk' in plan_filtering(dense).explain()
+
+
+def test_gather_stats():
+    read_filter = ReadFilter.from_classifications(
+        kraken2_results=k2_results,
+        kraken2_kreport=k2_report)
+    stats = gather_stats(read_filter, r1, r2, FASTQ, False)
+    assert stats.n_reads == 10000
+    assert stats.n_kept == len(read_filter)
+    assert stats.compression == GZIP
+    assert stats.uncompressed_bytes > stats.reads_bytes
+    assert stats.results_in_reads_order, \
+        'First sampled reads are in Kraken2 results order'
+    assert not stats.results_order_verified, \
+        'Gzip reads must only be sampled at the start'
+
+
+def test_gather_stats_results_order(tmpdir):
+    read_filter = ReadFilter.from_classifications(
+        kraken2_results=k2_results,
+        kraken2_kreport=k2_report)
+    records = {name.decode(): record for name, record, _ in iter_records(r1)}
+    ordered = [records[x] for x in read_filter.results_names()]
+    late_swap = ordered[:-10] + ordered[-5:] + ordered[-10:-5]
+    sam = str(tmpdir / 'reads.sam')
+    bam = str(tmpdir / 'reads.bam')
+    with open(sam, 'wb') as fsam, BgzfWriter.open(bam) as fbam:
+        fbam.write(b'BAM\x01' + struct.pack('<i', 0) + struct.pack('<i', 0))
+        for rec in ordered:
+            header, seq, _, qual = rec.split(b'\n')[:4]
+            name = header[1:].split()[0]
+            fsam.write(b'\t'.join([name, b'4', b'*', b'0', b'0', b'*', b'*',
+                                   b'0', b'0', seq, qual]) + b'\n')
+            fbam.write(bam_record(name, seq, qual, 4))
+    for name, records, fmt, in_order in [
+            ('ordered.fq', ordered, FASTQ, True),
+            ('ordered.fq.gz', ordered, FASTQ, True),
+            ('late_swap.fq', late_swap, FASTQ, False),
+            ('late_swap.fq.gz', late_swap, FASTQ, False),
+            ('reads.sam', None, SAM, True),
+            ('reads.bam', None, BAM, True)]:
+        path = str(tmpdir / name)
+        if records is not None:
+            with (BgzfWriter.open(path) if path.endswith('.gz')
+                  else open(path, 'wb')) as fout:
+                fout.write(b''.join(records))
+        stats = gather_stats(read_filter, path, None, fmt, False)
+        assert stats.results_in_reads_order == in_order, path
+        assert stats.results_order_verified, path
+
+
+def test_write_reads_strategies(tmpdir):
+    read_filter = ReadFilter.from_classifications(
+        kraken2_results=k2_results,
+        kraken2_kreport=k2_report,
+        exclude_unclassified=True)
+    reads = str(tmpdir / 'reads.fq')
+    with open(reads, 'wb') as fout:
+        for _, record, _ in iter_records(r1):
+            fout.write(record)
+    outputs = {}
+    for strategy in [HASH, MERGE, INDEX, BLOOM]:
+        out = str(tmpdir / f'{strategy}.fq')
+        if strategy == BLOOM:
+            read_filter = read_filter.with_prefilter(str(tmpdir / 'ids.bin'))
+        cli.write_reads(reads, read_filter, out, strategy=strategy,
+                        index_dir=str(tmpdir))
+        assert is_bgzf(out), \
+            'FASTQ output must be BGZF compressed like seqtk+pbgzip output'
+        outputs[strategy] = [record for _, record, _ in iter_records(out)]
+    assert len(outputs[HASH]) == len(read_filter)
+    assert all(x == outputs[HASH] for x in outputs.values()), \
+        'All strategies must write the same reads'
+
+
+def test_available_memory(tmpdir, monkeypatch):
+    meminfo = tmpdir / 'meminfo'
+    meminfo.write('MemTotal:  8000000 kB\nMemFree:  100000 kB\n'
+                  'MemAvailable:  4000000 kB\n')
+    assert planner._meminfo_available(str(meminfo)) == 4000000 * 1024
+    limit = tmpdir / 'memory.max'
+    usage = tmpdir / 'memory.current'
+    limit.write('1000000\n')
+    usage.write('250000\n')
+    monkeypatch.setattr(planner, '_cgroup_memory_files',
+                        lambda: [(str(limit), str(usage))])
+    assert planner.available_memory() == 750000, \
+        'Available memory must be capped by the cgroup memory limit'
+    limit.write('max\n')
+    assert planner.available_memory() != 750000
+
+
+def test_command_line_explain():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli.main, ['-i', r1, '-I', r2,
+                                          '-o', 'R1.fq.gz', '-O', 'R2.fq.gz',
+                                          '-k', k2_results, '-K', k2_report,
+                                          '--explain'])
+        assert result.exit_code == 0
+        assert 'Chosen strategy:' in result.output
+        assert not os.path.exists('R1.fq.gz'), \
+            'No reads must be written with --explain'
+
+
+def test_provenance():
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        result = runner.invoke(cli.main, ['-i', r1, '-I', r2,
+                                          '-o', 'R1.fq.gz', '-O', 'R2.fq.gz',
+                                          '-k', k2_results, '-K', k2_report,
+                                          '-c', c_results, '-C', c_report,
+                                          '--exclude-unclassified',
+                                          '--provenance', 'provenance.npz'])
+        assert result.exit_code == 0
+        df = read_provenance('provenance.npz')
+        assert list(df.columns) == ['read_id', 'kraken2_taxid',
+                                    'centrifuge_taxid', 'target_taxid',
+                                    'rule', 'mate_status']
+        assert df.read_id.is_unique
+        assert df.shape[0] == 10000
+        kept = df[df.rule.str.startswith('target')]
+        assert kept.shape[0] * 4 == count_lines('R1.fq.gz')
+        assert (kept.mate_status == 'paired').all(), \
+            'Both mates of kept reads must be written'
+        assert (kept.target_taxid == VIRUSES_TAXID).all()
+        dropped = df[~df.rule.str.startswith('target')]
+        assert (dropped.mate_status == 'not_written').all()
+        assert set(dropped.rule) == {'unclassified_excluded', 'not_target'}
+        df_rule = read_provenance('provenance.npz', columns=['rule'])
+        assert list(df_rule.columns) == ['rule']
+    maps = []
+    for taxids in [[VIRUSES_TAXID, 11320], [11320, VIRUSES_TAXID]]:
+        read_filter = ReadFilter.from_classifications(
+            kraken2_results=k2_results,
+            kraken2_kreport=k2_report,
+            taxids=taxids)
+        maps.append(target_taxid_map(read_filter))
+    assert maps[0] == maps[1], 'Order of nested targets must not matter'
+    assert maps[0][119210] == 11320, \
+        'Taxa must be mapped to the most specific target'
+    assert maps[0][VIRUSES_TAXID] == VIRUSES_TAXID
+    written = WrittenReads(np.array([b'a', b'b', b'c', b'd'],
+                                    dtype=np.bytes_))
+    on_write = written.observer()
+    for name, mate in [(b'a', 1), (b'a', 2), (b'b', 1), (b'c', 2),
+                       (b'd', 0), (b'missing', 1)]:
+        on_write(name, mate)
+    written.observer(2)(b'b', 0)
+    assert [MATE_STATUSES[x] for x in written.mate_status()] == \
+        ['paired', 'paired', 'mate2_only', 'single']